@@ -0,0 +1,197 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import gdnan
+from oauth2client.client import OAuth2Credentials
+from drive_emulator import DriveEmulator, discovery_document, G_DRIVE_DIR_MIME_TYPE
+
+WORKLOADS = ('small_uploads', 'packed_uploads', 'large_upload', 'clone', 'listing', 'search')
+TRANSPORTS = {'httplib2': None, 'pooled': gdnan.PooledTransport, 'http2': gdnan.Http2Transport}
+
+
+def client(server, args):
+    # Clients of the emulator are built from its own discovery document
+    gdnan.set_discovery_document(discovery_document(server.url))
+    credentials = OAuth2Credentials('benchmark', None, None, None, None, None, 'gdnan-benchmark')
+    rate_limiter = None if args.rate_limit else gdnan.RateLimiter(queries=10 ** 6, writes=10 ** 6)
+    transport = TRANSPORTS[args.transport](connections=args.workers) if TRANSPORTS[args.transport] else None
+    drive = gdnan.GoogleDrive(credentials, rate_limiter=rate_limiter, transport=transport)
+    drive.batch_uri = server.url + 'batch/drive/v3'
+    return drive
+
+
+def small_files(args, workdir):
+    count, size = int(200 * args.scale), 64 * 1024
+    folder = os.path.join(workdir, 'small')
+    os.makedirs(folder)
+    for i in range(count):
+        with open(os.path.join(folder, f'{i}.bin'), 'wb') as f:
+            f.write(os.urandom(size))
+    return folder, count, size
+
+
+def small_uploads(server, drive, args, workdir):
+    folder, count, size = small_files(args, workdir)
+    yield
+    drive.upload(folder, workers=args.workers)
+    yield count, count * size
+
+
+# The same files as small_uploads, packed into tar shards of 4 MB
+def packed_uploads(server, drive, args, workdir):
+    folder, count, size = small_files(args, workdir)
+    yield
+    drive.uploadPacked(folder, 'root', workers=args.workers, shard_size=4 * 1024 * 1024)
+    yield count, count * size
+
+
+def large_upload(server, drive, args, workdir):
+    size = int(64 * 1024 * 1024 * args.scale)
+    path = os.path.join(workdir, 'large.bin')
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+    yield
+    drive.upload(path)
+    yield 1, size
+
+
+def clone(server, drive, args, workdir):
+    # Folders of `width` subfolders down to `depth` levels, each holding `width` files
+    width, depth, size = max(2, int(4 * args.scale ** 0.5)), 3, 4096
+
+    def spec(level):
+        files = {f'file{i}': b'x' * size for i in range(width)}
+        if level < depth:
+            files.update({f'folder{i}': spec(level + 1) for i in range(width)})
+        return files
+
+    source = server.store.add({'name': 'source', 'mimeType': G_DRIVE_DIR_MIME_TYPE})['id']
+    server.tree(source, spec(1))
+    yield
+    result = drive.clone(source, workers=args.workers)
+    yield result.files, result.bytes
+
+
+def listing(server, drive, args, workdir):
+    count = int(5000 * args.scale)
+    folder = server.store.add({'name': 'listing', 'mimeType': G_DRIVE_DIR_MIME_TYPE})['id']
+    for i in range(count):
+        server.store.add({'name': f'{i}.txt', 'parents': [folder]}, b'')
+    yield
+    files = drive.getFilesByFolderId(folder)
+    yield len(files), 0
+
+
+def search(server, drive, args, workdir):
+    count, queries = int(2000 * args.scale), 50
+    for i in range(count):
+        server.store.add({'name': f'report-{i % 100}-{i}.pdf'}, b'')
+    yield
+    found = 0
+    for i in range(queries):
+        files, _ = drive.search(f'report-{i}-', limit=100)
+        found += len(files)
+    yield found, 0
+
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))] if samples else None
+
+
+def run(name, args):
+    workdir = tempfile.mkdtemp(prefix='gdnan-benchmark-')
+    server = DriveEmulator(latency=args.latency, throughput=args.throughput, error_rate=args.error_rate,
+                           chunk_error_rate=args.chunk_error_rate, seed=args.seed).start()
+    try:
+        drive = client(server, args)
+        workload = globals()[name](server, drive, args, workdir)
+        # Setup runs until the first yield, only the rest is timed
+        next(workload)
+        server.reset_stats()
+        start = time.time()
+        files, size = next(workload)
+        seconds = time.time() - start
+        snapshot = drive.metrics.snapshot()
+        requests = sum(server.requests.values())
+        timings = [timing for endpoint in server.timings.values() for timing in endpoint]
+        return {
+            'seconds': round(seconds, 4),
+            'files': files,
+            'bytes': size,
+            'files_per_second': round(files / seconds, 2),
+            'mb_per_second': round(size / seconds / 1024 ** 2, 2),
+            'requests': requests,
+            'requests_per_second': round(requests / seconds, 2),
+            'injected_errors': server.errors,
+            'latency': {'p50': percentile(timings, 0.5), 'p99': percentile(timings, 0.99)},
+            'endpoints': {endpoint: {'requests': len(samples),
+                                     'p50': percentile(samples, 0.5),
+                                     'p99': percentile(samples, 0.99)}
+                          for endpoint, samples in sorted(server.timings.items())},
+            'client': {key: snapshot[key] for key in ('requests', 'errors', 'waits', 'retries')},
+        }
+    finally:
+        server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks gdnan against a local Drive API emulator.")
+    parser.add_argument('workloads', nargs='*', metavar='workload',
+                        help=f"any of {', '.join(WORKLOADS)} (default: all)")
+    parser.add_argument('--latency', type=float, default=0.01, help="seconds added to every request")
+    parser.add_argument('--throughput', type=float, default=0, help="bytes per second of a connection, 0 is unlimited")
+    parser.add_argument('--error-rate', type=float, default=0, help="share of requests failing with rateLimitExceeded")
+    parser.add_argument('--chunk-error-rate', type=float, default=0,
+                        help="share of resumable upload chunks failing with backendError")
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--scale', type=float, default=1.0, help="multiplies the size of every workload")
+    parser.add_argument('--rate-limit', action='store_true', help="keep the default client side rate limits")
+    parser.add_argument('--transport', choices=sorted(TRANSPORTS), default='httplib2',
+                        help="httplib2 per thread, or a pooled transport shared by all threads")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="also write the results to this JSON file")
+    args = parser.parse_args()
+    for name in args.workloads:
+        if name not in WORKLOADS:
+            parser.error(f"unknown workload {name}, choose from {', '.join(WORKLOADS)}")
+    args.workloads = args.workloads or WORKLOADS
+
+    results = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'revision': revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {key: value for key, value in vars(args).items() if key not in ('workloads', 'output')},
+        'workloads': {},
+    }
+    for name in args.workloads:
+        print(f"Running {name}...", file=sys.stderr)
+        results['workloads'][name] = run(name, args)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
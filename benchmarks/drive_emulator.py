@@ -0,0 +1,597 @@
+import re
+import json
+import time
+import uuid
+import random
+import hashlib
+import socket
+import threading
+import socketserver
+from email.parser import BytesParser
+from email.policy import HTTP as HTTP_POLICY
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+G_DRIVE_DIR_MIME_TYPE = "application/vnd.google-apps.folder"
+# Fields Drive returns when the request doesn't ask for any
+DEFAULT_FIELDS = ('kind', 'id', 'name', 'mimeType')
+
+
+# In memory Drive v3 server on localhost, covering the part of the API gdnan uses:
+# files, permissions, changes, multipart and resumable uploads, ranged downloads
+# and batches. Latency, bandwidth and rate limit errors can be injected.
+class DriveEmulator(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0, throughput=0, error_rate=0, error_reason='rateLimitExceeded',
+                 chunk_error_rate=0, seed=None):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), _Handler)
+        self.store = DriveStore()
+        self.latency = latency
+        # Bytes per second of every connection, 0 is unlimited
+        self.throughput = throughput
+        self.error_rate = error_rate
+        self.error_reason = error_reason
+        self.chunk_error_rate = chunk_error_rate
+        self.random = random.Random(seed)
+        self.requests = {}
+        self.timings = {}
+        self.errors = 0
+        self.__lock = threading.Lock()
+        self.__thread = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/'
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def reset_stats(self):
+        with self.__lock:
+            self.requests, self.timings, self.errors = {}, {}, 0
+
+    def record(self, endpoint, seconds):
+        with self.__lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            self.timings.setdefault(endpoint, []).append(seconds)
+
+    def inject_error(self):
+        if not self.error_rate:
+            return False
+        with self.__lock:
+            injected = self.random.random() < self.error_rate
+            self.errors += injected
+        return injected
+
+    def transfer(self, size):
+        if self.throughput and size:
+            time.sleep(size / self.throughput)
+
+    # Creates folders and files below parent from {name: bytes or {...}}
+    def tree(self, parent, spec):
+        for name, value in spec.items():
+            if isinstance(value, dict):
+                folder = self.store.add({'name': name, 'mimeType': G_DRIVE_DIR_MIME_TYPE, 'parents': [parent]})
+                self.tree(folder['id'], value)
+            else:
+                self.store.add({'name': name, 'parents': [parent]}, value)
+
+
+class DriveStore:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.files = {'root': {'kind': 'drive#file', 'id': 'root', 'name': 'My Drive',
+                               'mimeType': G_DRIVE_DIR_MIME_TYPE, 'parents': [], 'trashed': False}}
+        self.children = {}
+        self.content = {}
+        self.sessions = {}
+        self.changes = []
+        self.__counter = 0
+
+    def __new_id(self):
+        self.__counter += 1
+        return '1%032d' % self.__counter
+
+    def add(self, meta, content=None):
+        with self.lock:
+            file = dict(meta, id=self.__new_id(), kind='drive#file', trashed=False)
+            file.setdefault('mimeType', 'application/octet-stream')
+            file.setdefault('parents', ['root'])
+            self.files[file['id']] = file
+            self.__link(file)
+            if content is not None or file['mimeType'] != G_DRIVE_DIR_MIME_TYPE:
+                self.__set_content(file, content or b'')
+            self.__touch(file)
+            return file
+
+    def put(self, file_id, meta, content):
+        if file_id is None:
+            return self.add(meta, content)
+        with self.lock:
+            file = self.files[file_id]
+            file.update(meta)
+            self.__set_content(file, content)
+            self.__touch(file)
+            return file
+
+    def update(self, file_id, meta, add_parents=None, remove_parents=None):
+        with self.lock:
+            file = self.files[file_id]
+            self.__unlink(file)
+            file.update(meta)
+            if add_parents or remove_parents:
+                parents = [parent for parent in file['parents'] if parent not in (remove_parents or [])]
+                file['parents'] = parents + [parent for parent in add_parents or [] if parent not in parents]
+            self.__link(file)
+            self.__touch(file)
+            return file
+
+    def delete(self, file_id):
+        with self.lock:
+            file = self.files.pop(file_id)
+            self.__unlink(file)
+            self.content.pop(file_id, None)
+            self.changes.append((file_id, True))
+            for child in list(self.children.get(file_id, ())):
+                if child in self.files:
+                    self.delete(child)
+
+    def __set_content(self, file, content):
+        self.content[file['id']] = bytes(content)
+        file['size'] = str(len(content))
+        file['md5Checksum'] = hashlib.md5(content).hexdigest()
+
+    def __touch(self, file):
+        file['modifiedTime'] = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())
+        self.changes.append((file['id'], False))
+
+    def __link(self, file):
+        for parent in file.get('parents', []):
+            self.children.setdefault(parent, {})[file['id']] = None
+
+    def __unlink(self, file):
+        for parent in file.get('parents', []):
+            self.children.get(parent, {}).pop(file['id'], None)
+
+    def query(self, q):
+        predicate, parents = compile_query(q)
+        with self.lock:
+            if parents is None:
+                candidates = [file_id for file_id in self.files if file_id != 'root']
+            else:
+                candidates = {file_id for parent in parents for file_id in self.children.get(parent, ())}
+            return [self.files[file_id] for file_id in sorted(candidates) if predicate(self.files[file_id])]
+
+
+_TOKEN = re.compile(r"\s*(\(|\)|'(?:[^'\\]|\\.)*'|!=|=|[A-Za-z]+)")
+
+
+# Compiles the subset of the Drive query language gdnan sends into a predicate,
+# along with the parents the matches have to be in, or None for any.
+def compile_query(q):
+    if not q:
+        return (lambda file: True), None
+    tokens, position = [], 0
+    q = q.strip()
+    while position < len(q):
+        match = _TOKEN.match(q, position)
+        if match is None:
+            raise ValueError(f"Invalid query: {q}")
+        tokens.append(match.group(1))
+        position = match.end()
+        while position < len(q) and q[position].isspace():
+            position += 1
+    tokens.append(None)
+    state = {'at': 0}
+
+    def peek():
+        return tokens[state['at']]
+
+    def take(expected=None):
+        token = tokens[state['at']]
+        if expected is not None and token != expected:
+            raise ValueError(f"Invalid query: {q}")
+        state['at'] += 1
+        return token
+
+    def string():
+        token = take()
+        if not token or token[0] != "'":
+            raise ValueError(f"Invalid query: {q}")
+        return re.sub(r"\\(.)", r"\1", token[1:-1])
+
+    def expression():
+        predicate, parents = term()
+        while peek() == 'or':
+            take()
+            other, other_parents = term()
+            predicate = (lambda a, b: lambda file: a(file) or b(file))(predicate, other)
+            parents = None if parents is None or other_parents is None else parents | other_parents
+        return predicate, parents
+
+    def term():
+        predicate, parents = factor()
+        while peek() == 'and':
+            take()
+            other, other_parents = factor()
+            predicate = (lambda a, b: lambda file: a(file) and b(file))(predicate, other)
+            parents = other_parents if parents is None else parents if other_parents is None else parents & other_parents
+        return predicate, parents
+
+    def factor():
+        token = peek()
+        if token == 'not':
+            take()
+            predicate, _ = factor()
+            return (lambda file: not predicate(file)), None
+        if token == '(':
+            take()
+            result = expression()
+            take(')')
+            return result
+        if token and token[0] == "'":
+            value = string()
+            take('in')
+            take('parents')
+            return (lambda file: value in file.get('parents', ())), {value}
+        field, operator = take(), take()
+        if field == 'trashed':
+            value = take() == 'true'
+            return (lambda file: bool(file.get('trashed')) == value), None
+        value = string()
+        if field == 'name' and operator == 'contains':
+            value = value.lower()
+            return (lambda file: value in file.get('name', '').lower()), None
+        if field in ('name', 'mimeType') and operator in ('=', '!='):
+            equal = operator == '='
+            return (lambda file: (file.get(field) == value) == equal), None
+        raise ValueError(f"Unsupported query: {q}")
+
+    result = expression()
+    if peek() is not None:
+        raise ValueError(f"Invalid query: {q}")
+    return result
+
+
+# Top level fields of a fields parameter, with the fields asked for in a
+# nested selection like files(id, name)
+def parse_fields(fields):
+    selected, depth, current = {}, 0, ''
+    for char in (fields or '') + ',':
+        if char == ',' and depth == 0:
+            name, _, nested = current.strip().partition('(')
+            if name:
+                selected[name.strip()] = nested[:-1] or None
+            current = ''
+            continue
+        depth += (char == '(') - (char == ')')
+        current += char
+    return selected
+
+
+def project(file, fields):
+    if fields == '*':
+        return dict(file)
+    names = [name for name in parse_fields(fields)] if fields else DEFAULT_FIELDS
+    return {name: file[name] for name in names if name in file}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    # Headers and body are written separately, without this every response
+    # waits on the delayed ACK of the client
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_PATCH(self):
+        self.handle_request('PATCH')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+    def handle_request(self, method):
+        start = time.time()
+        server = self.server
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        data = self.rfile.read(length) if length else b''
+        server.transfer(len(data))
+        if server.latency:
+            time.sleep(server.latency)
+        if url.path.startswith('/batch/'):
+            status, headers, body = self.batch(data)
+        else:
+            status, headers, body = self.dispatch(method, url, self.headers, data)
+        server.transfer(len(body) if headers.get('Content-Type') == 'application/octet-stream' else 0)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        server.record(endpoint(method, url.path), time.time() - start)
+
+    def dispatch(self, method, url, headers, data):
+        # Long GET requests are sent as POST by the client
+        override = headers.get('X-HTTP-Method-Override')
+        if override:
+            method, url, data = override, url._replace(query=data.decode()), b''
+        try:
+            # Chunks of resumable uploads are never rate limited
+            if self.server.inject_error() and not url.path.startswith('/upload/session/'):
+                result = error(403, self.server.error_reason, 'Rate Limit Exceeded')
+            else:
+                result = self.route(method, url.path, parse_qs(url.query), headers, data)
+        except KeyError as err:
+            result = error(404, 'notFound', f'File not found: {err.args[0]}.')
+        except ValueError as err:
+            result = error(400, 'invalid', str(err))
+        status, body, extra = result if len(result) == 3 else result + ({},)
+        if isinstance(body, bytes):
+            return status, dict({'Content-Type': 'application/octet-stream'}, **extra), body
+        content = json.dumps(body).encode() if body is not None else b''
+        return status, dict({'Content-Type': 'application/json; charset=UTF-8'}, **extra), content
+
+    def route(self, method, path, qs, headers, data):
+        store = self.server.store
+        param = lambda name, default=None: qs.get(name, [default])[0]
+        fields = param('fields')
+        if path == '/drive/v3/files' and method == 'GET':
+            files = store.query(param('q'))
+            size, start = min(int(param('pageSize', 100)), 1000), int(param('pageToken') or 0)
+            nested = parse_fields(fields).get('files') if fields else None
+            body = {'kind': 'drive#fileList', 'files': [project(file, nested) for file in files[start:start + size]]}
+            if start + size < len(files):
+                body['nextPageToken'] = str(start + size)
+            return 200, body
+        if path == '/drive/v3/files' and method == 'POST':
+            return 200, project(store.add(json.loads(data or b'{}')), fields)
+        if path == '/drive/v3/files/trash' and method == 'DELETE':
+            with store.lock:
+                for file_id in [file_id for file_id, file in store.files.items() if file.get('trashed')]:
+                    if file_id in store.files:
+                        store.delete(file_id)
+            return 204, None
+        if path.startswith('/upload/session/'):
+            return self.session(method, path.rsplit('/', 1)[1], headers, data, fields)
+        if path.startswith('/upload/drive/v3/files'):
+            file_id = path[len('/upload/drive/v3/files/'):] or None
+            return self.upload(param('uploadType', 'multipart'), file_id, headers, data, fields)
+        if path == '/drive/v3/changes/startPageToken':
+            return 200, {'kind': 'drive#startPageToken', 'startPageToken': str(len(store.changes))}
+        if path == '/drive/v3/changes':
+            start, size = int(param('pageToken')), int(param('pageSize', 100))
+            nested = parse_fields(parse_fields(fields).get('changes') or '').get('file') if fields else None
+            with store.lock:
+                page = store.changes[start:start + size]
+                changes = [{'fileId': file_id, 'removed': removed or file_id not in store.files,
+                            'file': project(store.files[file_id], nested) if file_id in store.files else None}
+                           for file_id, removed in page]
+                body = {'kind': 'drive#changeList', 'changes': changes}
+                if start + size < len(store.changes):
+                    body['nextPageToken'] = str(start + size)
+                else:
+                    body['newStartPageToken'] = str(len(store.changes))
+            return 200, body
+        match = re.match(r'^/drive/v3/files/([^/]+)(/[a-z]+)?$', path)
+        if match is None:
+            return error(404, 'notFound', f'Unknown path {path}')
+        file_id, action = match.groups()
+        file = store.files[file_id]
+        if action == '/copy' and method == 'POST':
+            meta = {key: value for key, value in file.items() if key in ('name', 'mimeType', 'description')}
+            meta.update(json.loads(data or b'{}'))
+            return 200, project(store.add(meta, store.content.get(file_id)), fields)
+        if action == '/permissions' and method == 'POST':
+            permission = json.loads(data or b'{}')
+            return 200, {'kind': 'drive#permission', 'id': 'anyoneWithLink',
+                         'type': permission.get('type'), 'role': permission.get('role')}
+        if action is None and method == 'GET' and param('alt') == 'media':
+            return self.download(store.content.get(file_id, b''), headers.get('Range'))
+        if action is None and method == 'GET':
+            return 200, project(file, fields)
+        if action is None and method == 'PATCH':
+            split = lambda value: value.split(',') if value else None
+            file = store.update(file_id, json.loads(data or b'{}'),
+                                split(param('addParents')), split(param('removeParents')))
+            return 200, project(file, fields)
+        if action is None and method == 'DELETE':
+            store.delete(file_id)
+            return 204, None
+        return error(404, 'notFound', f'Unknown path {path}')
+
+    def download(self, content, byte_range):
+        if not byte_range:
+            return 200, content
+        start, end = re.match(r'bytes=(\d+)-(\d*)', byte_range).groups()
+        start, end = int(start), min(int(end) if end else len(content) - 1, len(content) - 1)
+        if start >= len(content):
+            return error(416, 'requestedRangeNotSatisfiable', 'Request range not satisfiable')
+        return 206, content[start:end + 1], {'Content-Range': f'bytes {start}-{end}/{len(content)}'}
+
+    def upload(self, kind, file_id, headers, data, fields):
+        store = self.server.store
+        if kind == 'resumable':
+            session = uuid.uuid4().hex
+            store.sessions[session] = {'meta': json.loads(data or b'{}'), 'data': bytearray(),
+                                       'file_id': file_id, 'fields': fields}
+            return 200, None, {'Location': f"http://{headers.get('Host')}/upload/session/{session}"}
+        if kind == 'media':
+            return 200, project(store.put(file_id, {}, data), fields)
+        message = BytesParser(policy=HTTP_POLICY).parsebytes(
+            b'Content-Type: ' + headers.get('Content-Type').encode() + b'\r\n\r\n' + data)
+        parts = list(message.iter_parts())
+        meta = json.loads(parts[0].get_payload(decode=True))
+        content = parts[1].get_payload(decode=True) if len(parts) > 1 else b''
+        return 200, project(store.put(file_id, meta, content), fields)
+
+    def session(self, method, session_id, headers, data, fields):
+        store = self.server.store
+        session = store.sessions.get(session_id)
+        if session is None:
+            return error(404, 'notFound', 'Upload session expired')
+        if method == 'DELETE':
+            del store.sessions[session_id]
+            return error(499, 'cancelled', 'Client Closed Request')
+        content_range = headers.get('Content-Range') or ''
+        match = re.match(r'bytes (\d+)-(\d+)/(\d+|\*)', content_range)
+        total = match.group(3) if match else content_range.rpartition('/')[2]
+        # googleapiclient sends an empty stream as a PUT without range, like Drive
+        # that finishes the upload with what was received
+        if not content_range and not data:
+            total = str(len(session['data']))
+        if match and int(match.group(1)) == len(session['data']):
+            if self.server.chunk_error_rate and self.server.random.random() < self.server.chunk_error_rate:
+                return error(503, 'backendError', 'Backend Error')
+            session['data'] += data
+        if total.isdigit() and len(session['data']) == int(total):
+            del store.sessions[session_id]
+            file = store.put(session['file_id'], session['meta'], bytes(session['data']))
+            return 200, project(file, session['fields'])
+        committed = {'Range': f"bytes=0-{len(session['data']) - 1}"} if session['data'] else {}
+        return 308, None, committed
+
+    def batch(self, data):
+        message = BytesParser(policy=HTTP_POLICY).parsebytes(
+            b'Content-Type: ' + self.headers.get('Content-Type').encode() + b'\r\n\r\n' + data)
+        output = b''
+        for part in message.iter_parts():
+            start = time.time()
+            head, _, body = re.split(rb'(\r?\n\r?\n)', part.get_payload(decode=True), 1)
+            lines = re.split(r'\r?\n', head.decode())
+            method, uri = lines[0].split(' ')[:2]
+            headers = _Headers(line.split(': ', 1) for line in lines[1:] if ': ' in line)
+            url = urlparse(uri)
+            status, response_headers, content = self.dispatch(method, url, headers, body)
+            self.server.record(endpoint(method, url.path), time.time() - start)
+            output += (b'--BATCH\r\nContent-Type: application/http\r\n'
+                       b'Content-ID: <response-' + part['Content-ID'].strip('<>').encode() + b'>\r\n\r\n' +
+                       f"HTTP/1.1 {status} OK\r\nContent-Type: {response_headers['Content-Type']}\r\n"
+                       f"Content-Length: {len(content)}\r\n\r\n".encode() + content + b'\r\n')
+        output += b'--BATCH--'
+        return 200, {'Content-Type': 'multipart/mixed; boundary=BATCH'}, output
+
+
+# Case insensitive headers of the requests in a batch
+class _Headers(dict):
+    def __init__(self, items):
+        dict.__init__(self, ((name.lower(), value) for name, value in items))
+
+    def get(self, name, default=None):
+        return dict.get(self, name.lower(), default)
+
+
+def error(status, reason, message):
+    return status, {'error': {'code': status, 'message': message,
+                              'errors': [{'domain': 'usageLimits', 'reason': reason, 'message': message}]}}
+
+
+# Request path with the file and session ids taken out
+def endpoint(method, path):
+    path = re.sub(r'/upload/session/\w+', '/upload/session/{id}', path)
+    return method + ' ' + re.sub(r'/files/(?!trash\b)[^/]+', '/files/{id}', path)
+
+
+def _method(id, path, http_method, parameters=(), media=False, download=False):
+    method = {
+        'id': id,
+        'path': path,
+        'flatPath': path,
+        'httpMethod': http_method,
+        'parameters': {name: dict(kind, location='query') for name, kind in _PARAMETERS.items()},
+        'parameterOrder': [],
+        'response': {'$ref': 'File'},
+    }
+    for name in parameters:
+        method['parameters'][name] = {'type': 'string', 'location': 'path', 'required': True}
+        method['parameterOrder'].append(name)
+    if http_method in ('POST', 'PATCH'):
+        method['request'] = {'$ref': 'File'}
+    if media:
+        method['supportsMediaUpload'] = True
+        method['mediaUpload'] = {'accept': ['*/*'], 'maxSize': '5497558138880',
+                                 'protocols': {'simple': {'multipart': True, 'path': '/upload/drive/v3/' + path},
+                                               'resumable': {'multipart': True,
+                                                             'path': '/resumable/upload/drive/v3/' + path}}}
+    if download:
+        method['supportsMediaDownload'] = True
+        method['useMediaDownloadService'] = True
+    return method
+
+
+_PARAMETERS = {name: {'type': kind} for name, kind in (
+    ('acknowledgeAbuse', 'boolean'), ('addParents', 'string'), ('corpora', 'string'), ('driveId', 'string'),
+    ('includeItemsFromAllDrives', 'boolean'), ('includeTeamDriveItems', 'boolean'), ('orderBy', 'string'),
+    ('pageSize', 'integer'), ('pageToken', 'string'), ('q', 'string'), ('removeParents', 'string'),
+    ('spaces', 'string'), ('supportsAllDrives', 'boolean'), ('supportsTeamDrives', 'boolean'),
+    ('teamDriveId', 'string'), ('restrictToMyDrive', 'boolean'))}
+
+
+# Discovery document of the Drive v3 methods the emulator serves, pointed at
+# root_url, so clients are built without fetching the real one
+def discovery_document(root_url):
+    return {
+        'kind': 'discovery#restDescription',
+        'discoveryVersion': 'v1',
+        'id': 'drive:v3',
+        'name': 'drive',
+        'version': 'v3',
+        'protocol': 'rest',
+        'rootUrl': root_url,
+        'servicePath': 'drive/v3/',
+        'basePath': '/drive/v3/',
+        'baseUrl': root_url + 'drive/v3/',
+        'batchPath': 'batch/drive/v3',
+        'parameters': {
+            'alt': {'type': 'string', 'default': 'json', 'enum': ['json', 'media'], 'location': 'query'},
+            'fields': {'type': 'string', 'location': 'query'},
+            'prettyPrint': {'type': 'boolean', 'location': 'query'},
+            'quotaUser': {'type': 'string', 'location': 'query'},
+        },
+        'schemas': {'File': {'id': 'File', 'type': 'object', 'properties': {}}},
+        'resources': {
+            'files': {'methods': {
+                'list': _method('drive.files.list', 'files', 'GET'),
+                'create': _method('drive.files.create', 'files', 'POST', media=True),
+                'get': _method('drive.files.get', 'files/{fileId}', 'GET', ['fileId'], download=True),
+                'update': _method('drive.files.update', 'files/{fileId}', 'PATCH', ['fileId'], media=True),
+                'copy': _method('drive.files.copy', 'files/{fileId}/copy', 'POST', ['fileId']),
+                'delete': _method('drive.files.delete', 'files/{fileId}', 'DELETE', ['fileId']),
+                'emptyTrash': _method('drive.files.emptyTrash', 'files/trash', 'DELETE'),
+            }},
+            'permissions': {'methods': {
+                'create': _method('drive.permissions.create', 'files/{fileId}/permissions', 'POST', ['fileId']),
+            }},
+            'changes': {'methods': {
+                'getStartPageToken': _method('drive.changes.getStartPageToken', 'changes/startPageToken', 'GET'),
+                'list': _method('drive.changes.list', 'changes', 'GET'),
+            }},
+        },
+    }
@@ -0,0 +1,67 @@
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+# Only the first client may import these
+HEAVY_MODULES = ('googleapiclient', 'oauth2client', 'google', 'httplib2', 'tenacity', 'aiohttp', 'urllib3',
+                 'httpx', 'asyncio')
+
+
+# Returns the cumulative import time of every top level module in microseconds
+def importtime(code):
+    env = dict(os.environ, PYTHONPATH=SRC)
+    # The warm up run writes the bytecode, compiling isn't part of the startup
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], env=env, check=True,
+                            stderr=subprocess.PIPE).stderr.decode()
+    modules = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not name.startswith('  '):
+            modules[name.strip()] = int(cumulative)
+    return modules
+
+
+# Median milliseconds spent importing the modules the interpreter doesn't import on its own
+def measure(code, runs):
+    startup = importtime('pass')
+    importtime(code)
+    samples = [{name: time for name, time in importtime(code).items() if name not in startup} for _ in range(runs)]
+    totals = sorted(sum(modules.values()) for modules in samples)
+    return totals[len(totals) // 2] / 1000, samples[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures the startup cost of import gdnan with -X importtime.")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--max-ms', type=float, default=100, help="fail if import gdnan takes longer")
+    parser.add_argument('--output', help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    import_ms, modules = measure('import gdnan', args.runs)
+    client_ms, _ = measure('import gdnan; gdnan._load()', args.runs)
+    heavy = sorted(name for name in modules if name.split('.')[0] in HEAVY_MODULES)
+    results = {
+        'python': sys.version.split()[0],
+        'import_ms': round(import_ms, 2),
+        'first_client_ms': round(client_ms, 2),
+        'heavy_modules': heavy,
+    }
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+    if heavy:
+        sys.exit(f"import gdnan imported {', '.join(heavy)}")
+    if import_ms > args.max_ms:
+        sys.exit(f"import gdnan took {import_ms:.1f} ms, more than {args.max_ms} ms")
+
+
+if __name__ == '__main__':
+    main()
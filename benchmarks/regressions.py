@@ -0,0 +1,391 @@
+import os
+import sys
+import time
+import asyncio
+import shutil
+import hashlib
+import socket
+import threading
+import pathlib
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import gdnan
+from benchmark import client
+from oauth2client.client import OAuth2Credentials
+from drive_emulator import DriveEmulator
+
+# Behaviours which broke once, each check runs against a fresh emulator and
+# raises AssertionError when the behaviour is back.
+CHECKS = []
+
+
+def check(function):
+    CHECKS.append(function)
+    return function
+
+
+def options(**kwargs):
+    return argparse.Namespace(**dict({'rate_limit': False, 'transport': 'httplib2', 'workers': 4}, **kwargs))
+
+
+def local_tree(workdir, files):
+    for path, content in files.items():
+        path = os.path.join(workdir, *path.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+
+
+# The checkpoints of an upload job are on disk once upload() returns, a
+# new process sees the job finished and the files done
+@check
+def upload_job_checkpoints(server, workdir):
+    local_tree(workdir, {f'up/{i}.txt': b'x' * i for i in range(10)})
+    jobs = os.path.join(workdir, 'jobs.db')
+    code = ("import sys, argparse; sys.path[:0] = sys.argv[1:3]\n"
+            "from benchmark import client\n"
+            "from drive_emulator import DriveEmulator\n"
+            "server = argparse.Namespace(url=sys.argv[3])\n"
+            "drive = client(server, argparse.Namespace(rate_limit=False, transport='httplib2', workers=2))\n"
+            "drive.jobs = __import__('gdnan').JobJournal(sys.argv[4])\n"
+            "drive.upload(sys.argv[5], 'root', workers=2, job='up1')\n"
+            "import os; os._exit(0)\n")
+    here = os.path.dirname(os.path.abspath(__file__))
+    subprocess.run([sys.executable, '-c', code, here, os.path.join(here, '..', 'src'), server.url, jobs,
+                    os.path.join(workdir, 'up')], check=True)
+    journal = gdnan.JobJournal(jobs)
+    done = journal.start('up1', 'upload', os.path.abspath(os.path.join(workdir, 'up')), 'root')
+    assert journal.finished('up1'), "the job isn't marked finished"
+    assert len(done) == 11, f"{len(done)} of 11 checkpoints were committed"
+    journal.close()
+
+
+# Writes of the client are seen by reads answered from the tree cache, a
+# second sync has nothing left to transfer
+@check
+def tree_cache_writes(server, workdir):
+    local_tree(workdir, {'src/a.txt': b'a', 'src/sub/b.txt': b'bb'})
+    drive = client(server, options())
+    dest = drive.create_folder('dest', 'root').id
+    drive.tree_cache = gdnan.DriveTreeCache()
+    drive.updateTreeCache(force=True)
+    drive.sync(os.path.join(workdir, 'src'), dest)
+    names = sorted(file['name'] for file in drive.getFilesByFolderId(dest))
+    assert names == ['a.txt', 'sub'], f"the cache lists {names}"
+    plan = drive.sync(os.path.join(workdir, 'src'), dest)
+    assert not plan.transfers and not plan.folders, f"the second sync planned {plan}"
+    copy = drive.copyFile(drive.getFilesByFolderId(dest)[0]['id'], 'root')
+    assert drive.getFile(copy['id']), "the copy isn't in the cache"
+    drive.delete(copy['id'])
+    assert copy['id'] not in drive.tree_cache, "the deleted copy is still in the cache"
+
+
+# Siblings with the same name are all copied by clone_to_many
+@check
+def clone_to_many_duplicates(server, workdir):
+    local_tree(workdir, {'dup.txt': b'abc', 'other/dup.txt': b'dddd'})
+    drive = client(server, options())
+    folder = drive.create_folder('src', 'root').id
+    for path in ('dup.txt', 'other/dup.txt'):
+        drive.upload(os.path.join(workdir, *path.split('/')), folder)
+    dests = [drive.create_folder(f'dest{i}', 'root').id for i in range(2)]
+    for dest_id, result in drive.clone_to_many(folder, dests).items():
+        assert result.files == 2 and result.bytes == 7, f"{dest_id} got {result.files} files, {result.bytes} bytes"
+        names = [file['name'] for file in drive.getFilesByFolderId(result.file.id)]
+        assert names == ['dup.txt', 'dup.txt'], f"{dest_id} lists {names}"
+
+
+# A resumed clone copies siblings with the same name, and matches them by
+# size and md5 once they are there
+@check
+def clone_plan_duplicates(server, workdir):
+    local_tree(workdir, {'dup.txt': b'abc', 'other/dup.txt': b'dddd'})
+    drive = client(server, options())
+    folder = drive.create_folder('src', 'root').id
+    for path in ('dup.txt', 'other/dup.txt'):
+        drive.upload(os.path.join(workdir, *path.split('/')), folder)
+    for dedupe in (False, True):
+        dest = drive.create_folder(f'dest{dedupe}', 'root').id
+        result = drive.clone(folder, dest, workers=2, skip_existing=True, dedupe=dedupe)
+        assert result.files == 2 and result.bytes == 7, f"dedupe={dedupe} copied {result}"
+        plan = drive.planClone(folder, dest, dedupe=dedupe)
+        assert not plan.transfers and not plan.ambiguous, f"dedupe={dedupe} planned {plan.transfers} again"
+
+
+# upload() takes os.PathLike paths as paths, not as streams
+@check
+def upload_path_like(server, workdir):
+    local_tree(workdir, {'up/a.txt': b'a', 'up/sub/b.txt': b'bb'})
+    drive = client(server, options())
+    file = drive.upload(pathlib.Path(workdir, 'up', 'a.txt'), 'root')
+    size = drive.getFile(file.id).get('size')
+    assert file.name == 'a.txt' and int(size) == 1, f"uploaded {file.name} of {size} bytes"
+    result = drive.upload(pathlib.Path(workdir, 'up'), 'root', workers=2)
+    assert result.files == 2 and result.folders == 2, f"uploaded {result}"
+
+
+# A copy whose response timed out isn't sent again, Drive may have made it
+# already; a copy refused before it was sent is retried
+@check
+def copy_read_timeout(server, workdir):
+    local_tree(workdir, {'a.txt': b'a'})
+    socket.setdefaulttimeout(0.5)
+    try:
+        drive = client(server, options())
+    finally:
+        socket.setdefaulttimeout(None)
+    folder = drive.create_folder('dest', 'root').id
+    file = drive.upload(os.path.join(workdir, 'a.txt'), 'root')
+    # The emulator answers after the client gave up
+    server.handle_error = lambda request, address: None
+    server.latency = 1
+    try:
+        drive.copyFile(file.id, folder)
+        raise AssertionError("the copy didn't time out")
+    except gdnan.NetworkError:
+        pass
+    time.sleep(1.5)
+    server.latency = 0.001
+    copies = len(drive.getFilesByFolderId(folder))
+    assert copies == 1, f"the copy was made {copies} times"
+    assert gdnan.retry_policy(gdnan.network_error(ConnectionRefusedError()), False), "refused writes aren't retried"
+
+
+# A Drive to Drive sync answered from its index has nothing to copy again
+@check
+def sync_drive_index(server, workdir):
+    local_tree(workdir, {'src/a.txt': b'a', 'src/sub/b.txt': b'bb'})
+    drive = client(server, options())
+    folder = drive.upload(os.path.join(workdir, 'src'), 'root', workers=2).file.id
+    dest = drive.create_folder('dest', 'root').id
+    index = os.path.join(workdir, 'index.db')
+    plan = drive.sync(folder, dest, index=index)
+    assert plan.result.files == 2, f"the first sync copied {plan.result}"
+    plan = drive.sync(folder, dest, index=index, refresh=False)
+    assert not plan.transfers and not plan.folders, f"the second sync planned {plan}"
+
+
+# A sync copies every sibling with the same name, and with delete trashes
+# the extra copies in dest
+@check
+def sync_duplicates(server, workdir):
+    local_tree(workdir, {'dup.txt': b'abc', 'other/dup.txt': b'dddd'})
+    drive = client(server, options())
+    folder = drive.create_folder('src', 'root').id
+    for path in ('dup.txt', 'other/dup.txt'):
+        drive.upload(os.path.join(workdir, *path.split('/')), folder)
+    dest = drive.create_folder('dest', 'root').id
+    plan = drive.sync(folder, dest)
+    assert plan.result.files == 2 and plan.result.bytes == 7, f"the sync copied {plan.result}"
+    assert not drive.sync(folder, dest).transfers, "the second sync copies again"
+    drive.upload(os.path.join(workdir, 'dup.txt'), dest)
+    plan = drive.sync(folder, dest, delete=True)
+    assert not plan.transfers and len(plan.deletions) == 1, f"the extra copy isn't deleted: {plan}"
+    sizes = sorted(int(file['size']) for file in drive.getFilesByFolderId(dest, 'size'))
+    assert sizes == [3, 4], f"dest has files of {sizes} bytes"
+
+
+# A sync of a single local file uploads it, a path which is neither local nor
+# a Drive folder is a GoogleDriveError
+@check
+def sync_sources(server, workdir):
+    local_tree(workdir, {'a.txt': b'a', 'b.txt': b'bb'})
+    drive = client(server, options())
+    dest = drive.create_folder('dest', 'root').id
+    drive.upload(os.path.join(workdir, 'b.txt'), dest)
+    plan = drive.sync(os.path.join(workdir, 'a.txt'), dest, delete=True)
+    assert plan.result.files == 1 and not plan.deletions, f"the sync of a file planned {plan}"
+    names = sorted(file['name'] for file in drive.getFilesByFolderId(dest))
+    assert names == ['a.txt', 'b.txt'], f"dest lists {names}"
+    assert not drive.sync(os.path.join(workdir, 'a.txt'), dest).transfers, "the file is uploaded again"
+    try:
+        drive.sync(os.path.join(workdir, 'missing'), dest)
+        raise AssertionError("a missing path was synced")
+    except gdnan.GoogleDriveError:
+        pass
+
+
+# Siblings with the same name are downloaded to distinct local files
+@check
+def download_duplicates(server, workdir):
+    local_tree(workdir, {'dup.txt': b'abc', 'other/dup.txt': b'dddd'})
+    drive = client(server, options())
+    folder = drive.create_folder('src', 'root').id
+    for path in ('dup.txt', 'other/dup.txt'):
+        drive.upload(os.path.join(workdir, *path.split('/')), folder)
+    os.makedirs(os.path.join(workdir, 'down'))
+    result = drive.download(folder, os.path.join(workdir, 'down'), workers=4)
+    assert result.files == 2 and not result.failures, f"the download got {result}"
+    sizes = sorted(os.path.getsize(os.path.join(result.file, name)) for name in os.listdir(result.file))
+    assert sizes == [3, 4], f"the files downloaded have {sizes} bytes"
+
+
+# The pooled transports send the chunks of resumable uploads as they read
+# them from the file instead of reading each one whole first
+@check
+def transport_chunks(server, workdir):
+    data = os.urandom(12 * 1024 * 1024)
+    local_tree(workdir, {'big.bin': data})
+    bodies = []
+    send = gdnan.PooledTransport._send
+
+    def record(transport, uri, method, body, headers, follow):
+        if method == 'PUT':
+            bodies.append(body)
+        return send(transport, uri, method, body, headers, follow)
+
+    gdnan.PooledTransport._send = record
+    try:
+        for transport in ('pooled', 'http2'):
+            drive = client(server, options(transport=transport))
+            file = drive.upload(os.path.join(workdir, 'big.bin'), 'root')
+            meta = drive.getFile(file.id)
+            assert int(meta.get('size')) == len(data), f"{transport} uploaded {meta.get('size')} bytes"
+            assert meta.get('md5Checksum') == hashlib.md5(data).hexdigest(), f"{transport} uploaded other bytes"
+    finally:
+        gdnan.PooledTransport._send = send
+    whole = [len(body) for body in bodies if isinstance(body, bytes)]
+    assert bodies and not whole, f"chunks of {whole} bytes were read whole"
+
+
+# Every upload counts toward the daily bytes of its service account, small
+# multipart uploads and streams too
+@check
+def service_account_usage(server, workdir):
+    local_tree(workdir, {f'up/{i}.txt': b'x' * (i + 1) for i in range(10)})
+    drive = client(server, options())
+    pool = gdnan.ServiceAccountPool.__new__(gdnan.ServiceAccountPool)
+    pool.accounts = [gdnan.ServiceAccount(i, OAuth2Credentials(f'sa{i}', None, None, None, None, None, 'regressions'))
+                     for i in range(2)]
+    pool._ServiceAccountPool__next = 0
+    pool._ServiceAccountPool__lock = threading.Lock()
+    drive._GoogleDrive__pool = pool
+    drive.upload(os.path.join(workdir, 'up'), 'root', workers=2)
+    drive.upload(iter([b'abc', b'de']), 'root', name='stream.bin')
+    used = sum(account.bytes for account in pool.accounts)
+    assert used == 55 + 5, f"{used} of 60 bytes were counted"
+
+
+# After a rate limit error the budget comes back with time, not with the
+# number of requests which succeeded
+@check
+def rate_limit_recovery(server, workdir):
+    limiter = gdnan.RateLimiter(queries=150, writes=150)
+    limiter.throttled(gdnan.QUERY)
+    for _ in range(1000):
+        limiter.succeeded(gdnan.QUERY)
+    rate = limiter.buckets[gdnan.QUERY].rate
+    assert rate < 80, f"the rate is back to {rate:.0f}/s after 1000 requests"
+
+
+# AsyncGoogleDrive takes the same arguments and returns the same types as
+# GoogleDrive, and its calls work against the emulator
+@check
+def async_client(server, workdir):
+    local_tree(workdir, {'up/a.txt': b'a', 'up/sub/b.txt': b'bb', 'big.bin': b'x' * (6 * 1024 * 1024)})
+    drive = client(server, options())
+    folder = drive.create_folder('work', 'root').id
+
+    async def run():
+        credentials = OAuth2Credentials('regressions', None, None, None, None, None, 'regressions')
+        async with gdnan.AsyncGoogleDrive(credentials, f'https://drive.google.com/drive/folders/{folder}') as gd:
+            assert gd.parent_id == folder, f"the workdir is {gd.parent_id}"
+            up = await gd.upload(os.path.join(workdir, 'up'))
+            big = await gd.upload(os.path.join(workdir, 'big.bin'))
+            assert int(big.size) == 6 * 1024 * 1024, f"the resumable upload has {big.size} bytes"
+            moved = await gd.move(big.id, up.id)
+            assert isinstance(moved, gdnan.GoogleDriveFile), f"move returned a {type(moved).__name__}"
+            names = sorted(file['name'] for file in await gd.getFilesByFolderId(up.id))
+            assert names == ['a.txt', 'big.bin', 'sub'], f"the upload lists {names}"
+            copy = await gd.clone(up.id, 'root')
+            assert len(await gd.getFilesByFolderId(copy.id)) == 3, "the clone is missing files"
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run())
+    finally:
+        loop.close()
+
+
+# An empty stream is uploaded as an empty file
+@check
+def empty_stream(server, workdir):
+    drive = client(server, options())
+    done = []
+    thread = threading.Thread(target=lambda: done.append(drive.upload(iter([]), 'root', name='e.bin')), daemon=True)
+    thread.start()
+    thread.join(10)
+    assert done, "the upload of an empty stream doesn't finish"
+    size = drive.getFile(done[0].id).get('size')
+    assert int(size) == 0, f"the empty stream has {size} bytes"
+
+
+# Batched calls go out in batches of BATCH_SIZE through the emulator's
+# multipart/mixed endpoint, every call gets its own response or error and
+# rate limited calls are sent again
+@check
+def batch_calls(server, workdir):
+    drive = client(server, options())
+    parent = drive.create_folder('batch', 'root').id
+    names = [f'f{i}' for i in range(gdnan.BATCH_SIZE + 50)]
+    server.error_rate = 0.05
+    folders = drive.create_folders(names, parent)
+    server.error_rate = 0
+    failed = [folder for folder in folders if isinstance(folder, gdnan.GoogleDriveError)]
+    assert not failed, f"{len(failed)} folders failed: {failed[0]}"
+    assert sorted(folder.name for folder in folders) == sorted(names), "the folders don't match their names"
+    ids = [folder.id for folder in folders]
+    files = drive.getFiles(ids[:3] + ['1' * 33])
+    assert [file.get('name') for file in files[:3]] == names[:3], f"getFiles returned {files[:3]}"
+    assert isinstance(files[3], gdnan.NotFoundError), f"a missing file returned {files[3]}"
+    dest = drive.create_folder('dest', 'root').id
+    moved = drive.move_many(ids[:10], dest)
+    assert len(drive.getFilesByFolderId(dest)) == 10, f"move_many moved {moved}"
+    shared = drive.make_public_many(ids[:5])
+    assert not any(isinstance(response, gdnan.GoogleDriveError) for response in shared), f"make_public_many {shared}"
+    deleted = drive.delete_many(ids)
+    assert not any(isinstance(response, gdnan.GoogleDriveError) for response in deleted), f"delete_many {deleted}"
+    left = len(drive.getFilesByFolderId(parent)) + len(drive.getFilesByFolderId(dest))
+    assert not left, f"{left} folders weren't deleted"
+
+
+# uploaded_bytes can still be reset like the counter it used to be
+@check
+def uploaded_bytes_reset(server, workdir):
+    local_tree(workdir, {'a.txt': b'abc'})
+    drive = client(server, options())
+    drive.upload(os.path.join(workdir, 'a.txt'), 'root')
+    assert drive.uploaded_bytes == 3, f"uploaded_bytes is {drive.uploaded_bytes}"
+    drive.uploaded_bytes = 0
+    drive.upload(os.path.join(workdir, 'a.txt'), 'root')
+    assert drive.uploaded_bytes == 3, f"uploaded_bytes is {drive.uploaded_bytes} after a reset"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Checks fixed regressions against the local Drive API emulator.")
+    parser.add_argument('checks', nargs='*', metavar='check', help="names of the checks to run (default: all)")
+    args = parser.parse_args()
+    failed = 0
+    for function in CHECKS:
+        if args.checks and function.__name__ not in args.checks:
+            continue
+        workdir = tempfile.mkdtemp(prefix='gdnan-regression-')
+        server = DriveEmulator(latency=0.001).start()
+        try:
+            function(server, workdir)
+            print(f"ok      {function.__name__}")
+        except AssertionError as err:
+            failed += 1
+            print(f"FAILED  {function.__name__}: {err}")
+        finally:
+            server.stop()
+            shutil.rmtree(workdir, ignore_errors=True)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -28,5 +28,6 @@ setuptools.setup(
     python_requires='>=3.6',
     py_modules=["gdnan"],
     package_dir={'':'src'},
-    install_requires=requirements
+    install_requires=requirements,
+    extras_require={'async': ['aiohttp'], 'http2': ['httpx[http2]']}
 )
\ No newline at end of file
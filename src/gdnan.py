@@ -1,3 +1,4 @@
+import io
 import os
 import pickle
 import urllib.parse as urlparse
@@ -5,44 +6,326 @@ from urllib.parse import parse_qs
 
 import re
 import time
+import random
 import json
 import errno
+import hashlib
 import logging
+import sqlite3
+import shutil
+import socket
+import tarfile
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 from mimetypes import guess_type
-from httplib2 import Http
-from google.oauth2 import service_account
-from oauth2client.client import OAuth2Credentials, OAuth2WebServerFlow, FlowExchangeError
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
-from googleapiclient.http import MediaFileUpload
-from tenacity import *
 
 LOGGER = logging.getLogger(__name__)
 logging.getLogger('googleapiclient.discovery').setLevel(logging.ERROR)
 
+# Set by _load(), until then nothing can raise these
+_loaded = False
+class HttpError(Exception):
+    pass
+# Failures of the connection itself, extended by _load() with those of httplib2
+NETWORK_ERRORS = (OSError,)
+# Raised by PooledTransport and Http2Transport when no connection could be made
+class _ConnectError(ConnectionError):
+    pass
+# Those raised before anything was sent, extended by _load() and _load_async()
+UNSENT_ERRORS = (ConnectionRefusedError, socket.gaierror, _ConnectError)
+
+# The Google client libraries take hundreds of milliseconds to import, so they are only
+# imported by the first client. Helpers like extractId and create_link don't need them.
+def _load():
+    global httplib2, Http, service_account, google_auth_httplib2, OAuth2Credentials, OAuth2WebServerFlow, \
+        FlowExchangeError, build_from_document, HttpError, MediaFileUpload, MediaIoBaseUpload, \
+        BatchHttpRequest, build_http, NETWORK_ERRORS, UNSENT_ERRORS, _StreamUpload, _loaded
+    if _loaded:
+        return
+    import http.client
+    import httplib2
+    from httplib2 import Http
+    from google.oauth2 import service_account
+    import google_auth_httplib2
+    from oauth2client.client import OAuth2Credentials, OAuth2WebServerFlow, FlowExchangeError
+    from googleapiclient.discovery import build_from_document
+    from googleapiclient.errors import HttpError
+    from googleapiclient.http import MediaFileUpload, MediaIoBaseUpload, BatchHttpRequest, build_http
+    NETWORK_ERRORS = (OSError, http.client.HTTPException, httplib2.ServerNotFoundError)
+    UNSENT_ERRORS = UNSENT_ERRORS + (httplib2.ServerNotFoundError,)
+    _StreamUpload = _stream_upload_class(MediaIoBaseUpload)
+    _loaded = True
+
+def _load_async():
+    global asyncio, aiohttp, UNSENT_ERRORS
+    import asyncio
+    try:
+        import aiohttp
+    except ImportError:
+        aiohttp = None
+        return
+    # ConnectionTimeoutError is only in aiohttp >= 3.10
+    connect_errors = (aiohttp.ClientConnectorError, getattr(aiohttp, 'ConnectionTimeoutError', ConnectionRefusedError))
+    UNSENT_ERRORS = tuple(set(UNSENT_ERRORS + connect_errors))
+
 # Check https://developers.google.com/drive/scopes for all available scopes
 OAUTH_SCOPE = ['https://www.googleapis.com/auth/drive']
 # Redirect URI for installed apps, can be left as is
 REDIRECT_URI = "urn:ietf:wg:oauth:2.0:oob"
 # Google Drive Folder mimeType
 G_DRIVE_DIR_MIME_TYPE = "application/vnd.google-apps.folder"
+# Discovery document of Drive v3, fetched once and kept on disk and in memory
+DISCOVERY_URI = "https://www.googleapis.com/discovery/v1/apis/drive/v3/rest"
+DISCOVERY_CACHE = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'gdnan', 'drive.v3.json')
+DISCOVERY_TTL = 7 * 24 * 60 * 60
+# Fields of the entries kept by DriveTreeCache
+TREE_CACHE_FIELDS = 'id, name, mimeType, size, parents, md5Checksum, modifiedTime, trashed'
+# Fields of the remote entries compared by sync
+SYNC_FIELDS = 'id, name, mimeType, size, md5Checksum, modifiedTime'
+# Files up to this size are sent in a single multipart request instead of a resumable session
+MULTIPART_UPLOAD_SIZE = 5 * 1024 * 1024
+# Resumable uploads start with small chunks and adapt them to the measured throughput,
+# chunks must be multiples of 256 KiB
+CHUNK_SIZE_STEP = 256 * 1024
+INITIAL_CHUNK_SIZE = 1024 * 1024
+MAX_CHUNK_SIZE = 512 * 1024 * 1024
+# Time a single chunk should take to send
+CHUNK_TARGET_SECONDS = 5
+# PooledTransport and Http2Transport read the chunks from the file in blocks of this size
+SEND_BLOCK_SIZE = 1024 * 1024
+# Upper limit of file data held in memory by parallel uploads
+MAX_INFLIGHT_BYTES = 256 * 1024 * 1024
+# Downloads are split into ranged requests of this size, fetched concurrently
+DOWNLOAD_CHUNK_SIZE = 16 * 1024 * 1024
+# Chunks of open_stream, smaller so the first bytes arrive sooner
+STREAM_CHUNK_SIZE = 4 * 1024 * 1024
+# With pack, files under PACK_FILE_SIZE are uploaded in tar shards of about PACK_SHARD_SIZE,
+# the manifest lists the content of every shard
+PACK_FILE_SIZE = 1024 * 1024
+PACK_SHARD_SIZE = 256 * 1024 * 1024
+PACK_SHARD_NAME = 'gdnan-pack-{:05d}.tar'
+PACK_MANIFEST = 'gdnan-manifest.json'
+# Checkpoints of a job are committed every 100 items or every 2 seconds,
+# a crash loses at most this much progress
+CHECKPOINT_BATCH = 100
+CHECKPOINT_INTERVAL = 2
+# Batch endpoint of Drive API v3, a batch can contain at most 100 calls
+BATCH_URI = "https://www.googleapis.com/batch/drive/v3"
+BATCH_SIZE = 100
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+# Throughput is sampled at most every second and smoothed over the samples,
+# progress callbacks are called at most twice a second
+THROUGHPUT_INTERVAL = 1
+THROUGHPUT_SMOOTHING = 0.3
+PROGRESS_INTERVAL = 0.5
+# Largest page files.list returns, and the longest "in parents" query sent at once
+LIST_PAGE_SIZE = 1000
+MAX_QUERY_LENGTH = 4000
+# Reasons Drive gives for rate limit errors, quotas which won't recover by retrying soon,
+# and transient failures of its backend
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+QUOTA_REASONS = ('dailyLimitExceeded', 'quotaExceeded', 'storageQuotaExceeded', 'downloadQuotaExceeded',
+                 'sharingRateLimitExceeded', 'teamDriveFileLimitExceeded')
+SERVER_ERROR_REASONS = ('backendError', 'internalError')
+# Requests per second allowed for each credential, reads and writes have
+# separate budgets which are halved on every rate limit error and recover slowly
+QUERY = 'query'
+WRITE = 'write'
+QUERY_RATE = 150
+WRITE_RATE = 20
+# Service accounts can upload or copy 750 GB a day, an account which ran out of
+# quota is skipped for the cooldown of the error it got
+DAILY_UPLOAD_LIMIT = 750 * 1000 ** 3
+QUOTA_COOLDOWN = 24 * 60 * 60
+SERVICE_ACCOUNT_COOLDOWN = {'dailyLimitExceeded': QUOTA_COOLDOWN, 'userRateLimitExceeded': 10 * 60}
 
 
 class GoogleDrive:
-    def __init__(self, token, workdir=None):
-        self.__SERVICE_ACCOUNT_INDEX = 0
+    def __init__(self, token, workdir=None, journal=None, rate_limiter=None, tree_cache=None, metrics=None, jobs=None,
+                 search_cache=None, name_index=None, transport=None, dedup=None):
+        _load()
+        self.__rate_limiter = rate_limiter
+        self.metrics = metrics or TransferMetrics()
         self.__token = token
-        self.__service = self.authorize(self.__token)
+        self.__local = threading.local()
+        self.__generation = 0
+        self.__shared = None
+        self.transport = transport
+        self.__credentials = None
+        self.__pool = None
         self.__USE_SERVICE_ACCOUNTS = False
+        self.__service = self.authorize(self.__token)
         self._file_uploaded_bytes = 0
-        self.uploaded_bytes = 0
         self.start_time = 0
         self.total_time = 0
         self.parent_id = extractId(workdir) if workdir else "root"
         self.status = None
-        self.updater = None
+        self.batch_uri = BATCH_URI
+        self.journal = UploadJournal(journal) if isinstance(journal, str) else journal
+        self.tree_cache = DriveTreeCache(tree_cache) if isinstance(tree_cache, str) else tree_cache
+        self.jobs = JobJournal(jobs) if isinstance(jobs, str) else jobs
+        self.search_cache = search_cache
+        self.name_index = name_index
+        self.dedup = DedupCache(dedup) if isinstance(dedup, str) else dedup
+
+
+    # httplib2 is not thread-safe, so every thread gets its own authorized
+    # service object, rebuilt whenever the credentials are switched. On a
+    # pooled transport a single service is shared by all threads.
+    @property
+    def __service(self):
+        if self.__pool:
+            return self.__account.service(self.transport)
+        if self.transport is not None:
+            return self.__shared
+        if getattr(self.__local, 'generation', None) != self.__generation:
+            self.__local.service = build_service(self.__credentials)
+            self.__local.generation = self.__generation
+        return self.__local.service
+
+    @__service.setter
+    def __service(self, service):
+        self.__generation += 1
+        self.__shared = service
+        self.__local.service = service
+        self.__local.generation = self.__generation
+
+    # With service accounts every thread works with its own account, so
+    # concurrent work is spread over the whole pool.
+    @property
+    def __account(self):
+        account = getattr(self.__local, 'account', None)
+        if account is None:
+            account = self.__local.account = self.__pool.acquire()
+        return account
+
+    @property
+    def rate_limiter(self):
+        if self.__rate_limiter:
+            return self.__rate_limiter
+        return RateLimiter.shared(self.__account.credentials if self.__pool else self.__credentials)
+
+    # Called with a snapshot of the metrics as the transfers progress
+    @property
+    def updater(self):
+        return self.metrics.callback
+
+    @updater.setter
+    def updater(self, callback):
+        self.metrics.callback = callback
+
+    @property
+    def uploaded_bytes(self):
+        return self.metrics.bytes
+
+    # It was a plain counter, callers reset it with gd.uploaded_bytes = 0
+    @uploaded_bytes.setter
+    def uploaded_bytes(self, size):
+        self.metrics.set_bytes(size)
+
+    # Every API call goes through the rate limiter of the current credentials,
+    # reads and writes are budgeted separately. Failures are retried by the
+    # policy of their reason, see RETRY_POLICIES.
+    def __execute(self, request, call=None):
+        method = request.methodId + (':chunk' if call else '')
+        kind = QUERY if request.method == 'GET' else WRITE
+        read = request.method == 'GET' or request.headers.get('x-http-method-override') == 'GET'
+        # Chunks of a resumable upload go on from the committed offset, they can always be sent again
+        response = self.__retry(lambda: self.__send(method, kind, call or request.execute), request,
+                                read or call is not None)
+        # Any change made by this client may change search results
+        if self.search_cache is not None and not read:
+            self.search_cache.clear()
+        return response
 
+    # Sends until send() succeeds or fails with an error its policy doesn't retry. Resumable
+    # uploads keep their session, next_chunk() asks for the committed offset and goes on from there.
+    # Calls which aren't idempotent are only sent again if the first attempt never left.
+    def __retry(self, send, request=None, idempotent=True):
+        attempt = 0
+        while True:
+            try:
+                return send()
+            except GoogleDriveError as err:
+                # An account out of quota is set aside, the request goes on with the next one
+                if request is not None and self.__pool and err.reason in SERVICE_ACCOUNT_COOLDOWN:
+                    self.switchServiceAccount(err.reason)
+                    self.__rebind(request)
+                    continue
+                policy = retry_policy(err, idempotent)
+                if policy is None or attempt >= policy.retries:
+                    raise
+                delay = policy.delay(attempt, err.retry_after)
+                self.metrics.add_retry(err.reason, delay)
+                LOGGER.info(f"Got: {err.reason}, Trying Again in {delay:.1f}s.")
+                time.sleep(delay)
+                attempt += 1
+
+    # Makes a request use the account of this thread. The upload session of a file
+    # belongs to the account which started it, so it is started again.
+    def __rebind(self, request):
+        request.http = self.__service._http
+        if request.resumable is not None and request.resumable_uri and not isinstance(request.resumable, _StreamUpload):
+            request.resumable_uri = None
+            request.resumable_progress = 0
+            request._in_error_state = False
+
+    # A single attempt, failures are raised as the GoogleDriveError of their reason
+    def __send(self, method, kind, send):
+        limiter = self.rate_limiter if kind else None
+        if limiter:
+            self.__acquire(limiter, kind)
+        start = time.time()
+        try:
+            response = send()
+        except HttpError as err:
+            error = classify_error(err.resp.status, err.content, err.resp)
+            self.metrics.add_request(method, time.time() - start, error.reason)
+            if limiter and isinstance(error, RateLimitError):
+                limiter.throttled(kind)
+            raise error from err
+        except NETWORK_ERRORS as err:
+            self.metrics.add_request(method, time.time() - start, type(err).__name__)
+            raise network_error(err) from err
+        except Exception as err:
+            self.metrics.add_request(method, time.time() - start, type(err).__name__)
+            raise
+        self.metrics.add_request(method, time.time() - start)
+        if limiter:
+            limiter.succeeded(kind)
+        return response
+
+    # Files created or changed by this client are applied to the tree cache, and
+    # added to the name index if their folder is indexed
+    def __index(self, file, parent_id):
+        if not file or not parent_id:
+            return
+        file = dict(file, parents=[parent_id])
+        if self.tree_cache is not None:
+            self.tree_cache.apply([{'fileId': file['id'], 'file': file}])
+        if self.name_index is not None:
+            self.name_index.add(file)
+
+    def __unindex(self, file_id):
+        if self.tree_cache is not None:
+            self.tree_cache.apply([{'fileId': file_id, 'removed': True}])
+        if self.name_index is not None:
+            self.name_index.remove(file_id)
+
+    # With a tree cache, writes return every field it keeps
+    @property
+    def __write_fields(self):
+        return f'kind, {TREE_CACHE_FIELDS}' if self.tree_cache is not None else None
+
+    def __acquire(self, limiter, kind):
+        delay = limiter.reserve(kind)
+        if delay:
+            self.metrics.add_wait(kind, delay)
+            time.sleep(delay)
 
     def __upload_empty_file(self, path, file_name, mime_type, parent_id=None):
         media_body = MediaFileUpload(path,
@@ -55,19 +338,18 @@ class GoogleDrive:
         }
         if parent_id is not None:
             file_metadata['parents'] = [parent_id]
-        return self.__service.files().create(supportsTeamDrives=True,
-                                             body=file_metadata, media_body=media_body).execute()
-
-    def switchServiceAccount(self):
-        service_account_count = len(os.listdir(self.__token))
-        if self.__SERVICE_ACCOUNT_INDEX == service_account_count - 1:
-            self.__SERVICE_ACCOUNT_INDEX = 0
-        self.__SERVICE_ACCOUNT_INDEX += 1
-        LOGGER.info(f"Switching to {self.__SERVICE_ACCOUNT_INDEX}.json service account")
-        self.__service = self.authorize(self.__token)
+        return self.__execute(self.__service.files().create(supportsTeamDrives=True,
+                                             body=file_metadata, media_body=media_body))
+
+    def switchServiceAccount(self, reason='dailyLimitExceeded'):
+        self.__pool.exhausted(self.__account, reason)
+        self.__local.account = self.__pool.acquire()
+        LOGGER.info(f"Switching to {self.__local.account.index}.json service account")
+
+    def __add_usage(self, size):
+        if self.__pool:
+            self.__pool.add_usage(self.__account, size)
 
-    @retry(wait=wait_exponential(multiplier=2, min=3, max=6), stop=stop_after_attempt(5),
-           retry=retry_if_exception_type(HttpError), before=before_log(LOGGER, logging.DEBUG))
     def make_public(self, drive_id):
         permissions = {
             'role': 'reader',
@@ -75,166 +357,240 @@ class GoogleDrive:
             'value': None,
             'withLink': True
         }
-        try:
-            return self.__service.permissions().create(supportsTeamDrives=True, fileId=drive_id, body=permissions).execute()
-        except HttpError as err:
-            if err.resp.get('content-type', '').startswith('application/json'):
-                reason = json.loads(err.content).get('error').get('errors')[0].get('reason')
-                if reason == 'rateLimitExceeded':
-                    raise err
-                else:
-                    message = json.loads(err.content).get('error').get('errors')[0].get('message')
-                    raise GoogleDriveError(message) from None
+        return self.__execute(self.__service.permissions().create(supportsTeamDrives=True, fileId=drive_id, body=permissions))
 
 
-    @retry(wait=wait_exponential(multiplier=2, min=3, max=6), stop=stop_after_attempt(5),
-           retry=retry_if_exception_type(HttpError), before=before_log(LOGGER, logging.DEBUG))
-    def upload_file(self, file_path, file_name, mime_type, parent_id):
+    # With a dedup cache a file whose content was uploaded before is copied from
+    # that earlier file instead, no bytes are sent
+    def upload_file(self, file_path, file_name, mime_type, parent_id, file_id=None):
+        if self.dedup is None or file_id is not None:
+            return self.__upload_file(file_path, file_name, mime_type, parent_id, file_id)
+        size = os.path.getsize(file_path)
+        md5 = self.dedup.hashes.md5(file_path)
+        source = self.dedup.get(md5, size)
+        if source:
+            try:
+                copy = self.copyFile(source, parent_id, size, file_name)
+                if copy:
+                    LOGGER.info(f"Copied {file_path} from {source}, same content")
+                    return copy
+            except GoogleDriveError as err:
+                LOGGER.info(f"Couldn't copy {source}, uploading {file_path}: {err}")
+                self.dedup.remove(md5, size)
+        response = self.__upload_file(file_path, file_name, mime_type, parent_id)
+        self.dedup.put(md5, size, response['id'])
+        return response
+
+    def __upload_file(self, file_path, file_name, mime_type, parent_id, file_id=None):
         # File body description
         file_metadata = {
             'name': file_name,
             'description': 'uploaded by gdnan',
             'mimeType': mime_type,
         }
-        if parent_id is not None:
+        if parent_id is not None and file_id is None:
             file_metadata['parents'] = [parent_id]
 
-        if os.path.getsize(file_path) == 0:
+        # Replaces the content of an existing file when its id is given
+        def request(media_body):
+            if file_id:
+                return self.__service.files().update(supportsAllDrives=True, fileId=file_id, fields=self.__write_fields,
+                                                     body=file_metadata, media_body=media_body)
+            return self.__service.files().create(supportsTeamDrives=True, fields=self.__write_fields,
+                                                 body=file_metadata, media_body=media_body)
+
+        if os.path.getsize(file_path) <= MULTIPART_UPLOAD_SIZE:
             media_body = MediaFileUpload(file_path,
                                          mimetype=mime_type,
                                          resumable=False)
-            response = self.__service.files().create(supportsTeamDrives=True,
-                                                     body=file_metadata, media_body=media_body).execute()
-            drive_file = self.__service.files().get(supportsTeamDrives=True,
-                                                    fileId=response['id']).execute()
-            return drive_file
+            response = self.__execute(request(media_body))
+            self.__add_usage(media_body.size())
+            self.metrics.add_progress(media_body.size(), 1)
+            self.__index(response, parent_id)
+            return response
         media_body = MediaFileUpload(file_path,
                                      mimetype=mime_type,
                                      resumable=True,
-                                     chunksize=50 * 1024 * 1024)
+                                     chunksize=INITIAL_CHUNK_SIZE)
 
         # Insert a file
-        drive_file = self.__service.files().create(supportsTeamDrives=True,
-                                                   body=file_metadata, media_body=media_body)
+        drive_file = request(media_body)
+        stat = os.stat(file_path)
+        session = self.journal.get(file_path, parent_id, file_name, stat.st_size, stat.st_mtime) if self.journal else None
+        if session:
+            LOGGER.info(f"Resuming upload of {file_path} from {session[1]} bytes")
+            drive_file.resumable_uri = session[0]
+            # Makes next_chunk ask the server for the committed range before sending data
+            drive_file._in_error_state = True
+        sizer = ChunkSizer()
         response = None
         while response is None:
             try:
-                self.status, response = drive_file.next_chunk()
-            except HttpError as err:
-                if err.resp.get('content-type', '').startswith('application/json'):
-                    reason = json.loads(err.content).get('error').get('errors')[0].get('reason')
-                    if reason == 'userRateLimitExceeded' or reason == 'dailyLimitExceeded':
-                        if self.__USE_SERVICE_ACCOUNTS:
-                            self.switchServiceAccount()
-                            LOGGER.info(f"Got: {reason}, Trying Again.")
-                            return self.upload_file(file_path, file_name, mime_type, parent_id)
-                    elif reason == 'rateLimitExceeded':
-                        raise err
-                    else:
-                        message = json.loads(err.content).get('error').get('errors')[0].get('message')
-                        raise GoogleDriveError(message) from None
+                self.status, response = self.__next_chunk(drive_file, media_body, sizer)
+                if self.journal and response is None:
+                    self.journal.save(file_path, parent_id, file_name, stat.st_size, stat.st_mtime,
+                                      drive_file.resumable_uri, drive_file.resumable_progress)
+            except NotFoundError:
+                if not session:
+                    raise
+                LOGGER.info(f"Upload session of {file_path} expired, Starting Again.")
+                self.journal.remove(file_path, parent_id, file_name)
+                drive_file.resumable_uri = None
+                drive_file.resumable_progress = 0
+                drive_file._in_error_state = False
+                session = None
+        if self.journal:
+            self.journal.remove(file_path, parent_id, file_name)
+        self.__add_usage(stat.st_size)
+        self.metrics.add_progress(0, 1)
         self._file_uploaded_bytes = 0
         # Define file instance and get url for download
-        drive_file = self.__service.files().get(supportsTeamDrives=True, fileId=response['id']).execute()
+        drive_file = self.__execute(self.__service.files().get(supportsTeamDrives=True, fileId=response['id'],
+                                                               fields=self.__write_fields))
+        self.__index(drive_file, parent_id)
         return drive_file
 
 
-    def upload(self, file_path: str, folder=None):
+    # Streams which can't seek, like pipes and generators, are retried from
+    # the committed offset in place since they can't be read again.
+    def upload_stream(self, stream, file_name, mime_type, parent_id):
+        file_metadata = {
+            'name': file_name,
+            'description': 'uploaded by gdnan',
+            'mimeType': mime_type,
+        }
+        if parent_id is not None:
+            file_metadata['parents'] = [parent_id]
+        if hasattr(stream, 'seekable') and stream.seekable():
+            media_body = MediaIoBaseUpload(stream, mimetype=mime_type, chunksize=INITIAL_CHUNK_SIZE, resumable=True)
+        else:
+            media_body = _StreamUpload(stream, mime_type, INITIAL_CHUNK_SIZE)
+        drive_file = self.__service.files().create(supportsTeamDrives=True, fields=self.__write_fields,
+                                                   body=file_metadata, media_body=media_body)
+        sizer = ChunkSizer()
+        response = None
+        while response is None:
+            self.status, response = self.__next_chunk(drive_file, media_body, sizer)
+        # The size of a stream is known once it's read to its end
+        self.__add_usage(media_body.size() or 0)
+        self.metrics.add_progress(0, 1)
+        self.__index(response, parent_id)
+        return response
+
+    # A failed chunk is sent again smaller, from the offset the server committed
+    def __next_chunk(self, request, media_body, sizer):
+        offset = request.resumable_progress
+        attempt = []
+
+        def send():
+            media_body._chunksize = sizer.chunksize
+            if isinstance(media_body, _StreamUpload):
+                media_body.prefetch(request.resumable_progress + sizer.chunksize)
+            attempt[:] = [request.resumable_progress, time.time()]
+            try:
+                return request.next_chunk()
+            except Exception:
+                sizer.failed()
+                raise
+
+        status, response = self.__execute(request, send)
+        done = request.resumable_progress if response is None else media_body.size()
+        if response is None:
+            sizer.update(done - attempt[0], time.time() - attempt[1])
+        self._file_uploaded_bytes = done
+        self.metrics.add_progress(done - offset)
+        return status, response
+
+    def upload(self, file_path, folder=None, workers=None, name=None, job=None, pack=False):
         if self.__USE_SERVICE_ACCOUNTS:
-            self.service_account_count = len(os.listdir(self.__token))
+            self.service_account_count = len(self.__pool.accounts)
         if folder:
             parent_id = folder
         else:
             parent_id = self.parent_id
+        if isinstance(file_path, (str, os.PathLike)):
+            file_path = os.fspath(file_path)
+        else:
+            name = name or os.path.basename(str(getattr(file_path, 'name', '')))
+            if not name:
+                raise GoogleDriveError("A name is required to upload a stream.")
+            LOGGER.info("Uploading Stream: " + name)
+            file = self.upload_stream(file_path, name, self.get_mime_type(name), parent_id)
+            LOGGER.info("Uploaded To G-Drive: " + name)
+            return GoogleDriveFile(file)
         file_name = os.path.basename(file_path)
         LOGGER.info("Uploading File: " + file_path)
         self.start_time = time.time()
         if os.path.isfile(file_path):
             try:
+                self.metrics.add_total(os.path.getsize(file_path), 1)
                 mime_type = self.get_mime_type(file_path)
                 file = self.upload_file(file_path, file_name, mime_type, parent_id)
                 if file is None:
                     raise Exception('Upload has been manually cancelled')
                 file = GoogleDriveFile(file)
                 LOGGER.info("Uploaded To G-Drive: " + file_path)
-            except Exception as e:
-                if isinstance(e, RetryError):
-                    LOGGER.info(f"Total Attempts: {e.last_attempt.attempt_number}")
-                    err = e.last_attempt.exception()
-                else:
-                    err = e
-                raise GoogleDriveError(err) from None
-                return
+            except GoogleDriveError:
+                raise
+            except Exception as err:
+                raise GoogleDriveError(str(err)) from None
         elif os.path.isdir(file_path):
             try:
+                if pack:
+                    return self.uploadPacked(file_path, parent_id, workers or 4)
+                if workers or job:
+                    return self.uploadParallel(file_path, parent_id, workers or 1, job=job)
                 file = self.create_folder(os.path.basename(os.path.abspath(file_name)), parent_id)
                 result = self.upload_dir(file_path, file.id)
                 if result is None:
                     raise Exception('Upload has been manually cancelled!')
                 LOGGER.info("Uploaded To G-Drive: " + file_name)
-            except Exception as e:
-                if isinstance(e, RetryError):
-                    LOGGER.info(f"Total Attempts: {e.last_attempt.attempt_number}")
-                    err = e.last_attempt.exception()
-                else:
-                    err = e
-                raise GoogleDriveError(err) from None
-                return
+            except GoogleDriveError:
+                raise
+            except Exception as err:
+                raise GoogleDriveError(str(err)) from None
         else:
             raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), file_path)
+        self.total_time = time.time() - self.start_time
         return file
 
-    @retry(wait=wait_exponential(multiplier=2, min=3, max=6), stop=stop_after_attempt(5),
-           retry=retry_if_exception_type(HttpError), before=before_log(LOGGER, logging.DEBUG))
-    def copyFile(self, file_id, dest_id):
+    def copyFile(self, file_id, dest_id, size=None, name=None):
         body = {
             'parents': [dest_id]
         }
+        if name:
+            body['name'] = name
 
-        try:
-            res = self.__service.files().copy(supportsAllDrives=True,fileId=file_id,body=body).execute()
-            return res
-        except HttpError as err:
-            if err.resp.get('content-type', '').startswith('application/json'):
-                reason = json.loads(err.content).get('error').get('errors')[0].get('reason')
-                if reason == 'userRateLimitExceeded' or reason == 'dailyLimitExceeded':
-                    if self.__USE_SERVICE_ACCOUNTS:
-                        self.switchServiceAccount()
-                        LOGGER.info(f"Got: {reason}, Trying Again.")
-                        return self.copyFile(file_id,dest_id)
-                else:
-                    raise err
+        res = self.__execute(self.__service.files().copy(supportsAllDrives=True,fileId=file_id,body=body,
+                                                          fields=self.__write_fields))
+        self.__add_usage(int(size or 0))
+        self.metrics.add_progress(int(size or 0), 1)
+        self.__index(res, dest_id)
+        return res
 
-    @retry(wait=wait_exponential(multiplier=2, min=3, max=6), stop=stop_after_attempt(5),
-           retry=retry_if_exception_type(HttpError), before=before_log(LOGGER, logging.DEBUG))
     def getFile(self,file_id):
-        try:
-            return self.__service.files().get(supportsAllDrives=True, fileId=file_id,
-                                              fields="name,id,mimeType,size,parents").execute()
-        except HttpError as err:
-            if err.resp.get('content-type', '').startswith('application/json'):
-                reason = json.loads(err.content).get('error').get('errors')[0].get('reason')
-                if reason == 'rateLimitExceeded':
-                    raise err
-                else:
-                    message = json.loads(err.content).get('error').get('errors')[0].get('message')
-                    raise GoogleDriveError(message) from None
+        cache = self.__tree_cache()
+        if cache is not None and file_id in cache:
+            return cache.get(file_id)
+        return self.__execute(self.__service.files().get(supportsAllDrives=True, fileId=file_id,
+                                          fields="name,id,mimeType,size,parents,md5Checksum,modifiedTime"))
 
 
-    @retry(wait=wait_exponential(multiplier=2, min=3, max=6), stop=stop_after_attempt(5),
-           retry=retry_if_exception_type(HttpError), before=before_log(LOGGER, logging.DEBUG))
-    def getFilesByFolderId(self,folder_id):
+    def getFilesByFolderId(self, folder_id, fields='id, name, mimeType, size'):
+        cache = self.__tree_cache()
+        if cache is not None and cache.has_folder(folder_id):
+            return cache.children(folder_id)
         page_token = None
-        q = f"'{folder_id}' in parents"
+        q = f"'{folder_id}' in parents and trashed = false"
         files = []
         while True:
-            response = self.__service.files().list(supportsTeamDrives=True,
+            response = self.__execute(self.__service.files().list(supportsTeamDrives=True,
                                                    includeTeamDriveItems=True,
                                                    q=q,
                                                    spaces='drive',
-                                                   pageSize=200,
-                                                   fields='nextPageToken, files(id, name, mimeType,size)',
-                                                   pageToken=page_token).execute()
+                                                   pageSize=LIST_PAGE_SIZE,
+                                                   fields=f'nextPageToken, files({fields})',
+                                                   pageToken=page_token))
             for file in response.get('files', []):
                 files.append(file)
             page_token = response.get('nextPageToken', None)
@@ -242,7 +598,51 @@ class GoogleDrive:
                 break
         return files
 
-    def clone(self, file_id: str, folder=None):
+    # Streams every entry below a folder, including subfolders. Folders waiting to
+    # be listed are merged into one "in parents" query and several queries are
+    # paged concurrently instead of one query per folder.
+    def walk(self, folder_id, fields='id, name, mimeType, size', workers=4):
+        if 'parents' not in fields:
+            fields += ', parents'
+        frontier = [folder_id]
+        running = set()
+        executor = ThreadPoolExecutor(max_workers=workers)
+
+        def submit(parents, page_token=None):
+            q = "(" + " or ".join(f"'{parent}' in parents" for parent in parents) + ") and trashed = false"
+            future = executor.submit(self.__list_page, q=q, pageSize=LIST_PAGE_SIZE, pageToken=page_token,
+                                     fields=f'nextPageToken, files({fields})')
+            future.parents = parents
+            running.add(future)
+
+        def schedule():
+            while frontier and len(running) < workers:
+                parents, length = [], 0
+                while frontier and length < MAX_QUERY_LENGTH:
+                    parents.append(frontier.pop())
+                    length += len(parents[-1]) + 20
+                submit(parents)
+
+        try:
+            schedule()
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    running.discard(future)
+                    response = future.result()
+                    if response.get('nextPageToken'):
+                        submit(future.parents, response['nextPageToken'])
+                    for file in response.get('files', []):
+                        if file.get('mimeType') == G_DRIVE_DIR_MIME_TYPE:
+                            frontier.append(file['id'])
+                        yield file
+                schedule()
+        finally:
+            for future in running:
+                future.cancel()
+            executor.shutdown()
+
+    def clone(self, file_id: str, folder=None, workers=None, skip_existing=False, dedupe=False, job=None):
         self.transferred_size = 0
         if folder:
             parent_id = folder
@@ -252,23 +652,255 @@ class GoogleDrive:
             raise GoogleDriveError("Can't clone the working directory in itself.")
         LOGGER.info(f"File ID: {file_id}")
         try:
+            if skip_existing or dedupe:
+                plan = self.executePlan(self.planClone(file_id, parent_id, dedupe), workers)
+                self.transferred_size = plan.result.bytes
+                return plan.result
             meta = self.getFile(file_id)
+            if meta.get("mimeType") != G_DRIVE_DIR_MIME_TYPE:
+                self.metrics.add_total(int(meta.get('size') or 0), 1)
+            if workers or job:
+                return self.cloneParallel(meta, parent_id, workers or 1, job)
             if meta.get("mimeType") == G_DRIVE_DIR_MIME_TYPE:
                 file = self.create_folder(meta.get('name'), parent_id)
                 result = self.cloneFolder(meta.get('name'), meta.get('name'), meta.get('id'), file.id)
                 file.size = int(self.transferred_size)
             else:
-                file = self.copyFile(meta.get('id'), parent_id)
+                file = self.copyFile(meta.get('id'), parent_id, meta.get('size'))
                 file = GoogleDriveFile(file)
                 file.size = int(meta.get('size'))
+        except GoogleDriveError:
+            raise
         except Exception as err:
-            if isinstance(err, RetryError):
-                LOGGER.info(f"Total Attempts: {err.last_attempt.attempt_number}")
-                err = err.last_attempt.exception()
             err = str(err).replace('>', '').replace('<', '')
             raise GoogleDriveError(err) from None
         return file
 
+    # With a job id every finished item is checkpointed in the job journal, running
+    # the same job again skips them and reuses the folders it already created.
+    def cloneParallel(self, meta, parent_id, workers=8, job=None):
+        result = TransferResult()
+        done = self.__start_job(job, 'clone', meta.get('id'), parent_id)
+
+        def copy_file(file, dest_id):
+            if file.get('id') in done:
+                result.add_skipped()
+                return
+            try:
+                copy = self.copyFile(file.get('id'), dest_id, file.get('size'))
+                result.add_file(file.get('size'))
+                if job:
+                    self.jobs.done(job, file.get('id'), copy.get('id'))
+            except Exception as err:
+                result.add_failure(file, err)
+
+        def clone_folder(file, dest_id):
+            LOGGER.info(f"Syncing: {file.get('name')}")
+            tasks = []
+            for child in self.getFilesByFolderId(file.get('id')):
+                if child.get('mimeType') == G_DRIVE_DIR_MIME_TYPE:
+                    tasks.append((create_folder, child, dest_id))
+                else:
+                    self.metrics.add_total(int(child.get('size') or 0), 1)
+                    tasks.append((copy_file, child, dest_id))
+            return tasks
+
+        # Children are only scheduled once their destination folder exists.
+        def create_folder(file, dest_id):
+            try:
+                return clone_folder(file, self.__job_folder(job, done, result, file.get('id'), file.get('name'), dest_id))
+            except Exception as err:
+                result.add_failure(file, err)
+
+        if meta.get("mimeType") == G_DRIVE_DIR_MIME_TYPE:
+            folder_id = self.__job_folder(job, done, result, meta.get('id'), meta.get('name'), parent_id)
+            result.file = GoogleDriveFile(self.getFile(folder_id))
+            self.__run_tasks([(clone_folder, meta, folder_id)], workers)
+            result.file.size = result.bytes
+        elif meta.get('id') in done:
+            result.file = GoogleDriveFile(self.getFile(done[meta.get('id')]))
+            result.add_skipped()
+        else:
+            result.file = GoogleDriveFile(self.copyFile(meta.get('id'), parent_id, meta.get('size')))
+            result.add_file(meta.get('size'))
+            result.file.size = result.bytes
+            if job:
+                self.jobs.done(job, meta.get('id'), result.file.id)
+        self.__finish_job(job, result)
+        self.transferred_size = result.bytes
+        return result
+
+    def __start_job(self, job, kind, source, dest):
+        if not job:
+            return {}
+        if self.jobs is None:
+            raise GoogleDriveError("A job journal is required to run a job, pass jobs= to GoogleDrive.")
+        done = self.jobs.start(job, kind, source, dest)
+        if done:
+            LOGGER.info(f"Resuming job {job}, {len(done)} items already done")
+        return done
+
+    def __finish_job(self, job, result):
+        if job:
+            self.jobs.finish(job, not result.failures)
+
+    # Folders are checkpointed right away, they are reused by the items below them
+    def __job_folder(self, job, done, result, source, name, dest_id):
+        if source in done:
+            return done[source]
+        folder = self.create_folder(name, dest_id)
+        result.add_folder()
+        if job:
+            self.jobs.done(job, source, folder.id, flush=True)
+        return folder.id
+
+    # Clones a file or a folder into every destination, listing the source only once.
+    # The folders are created in all destinations as soon as their parents exist, then
+    # the copies of every file to each destination follow each other on the same pool.
+    # Returns a TransferResult per destination, callback(dest_id, result) follows them.
+    def clone_to_many(self, file_id, dest_ids, workers=8, callback=None):
+        if file_id in dest_ids:
+            raise GoogleDriveError("Can't clone a folder in itself.")
+        meta = self.getFile(file_id)
+        name = meta.get('name')
+        # Entries are kept by id with the id of their source folder, so siblings
+        # with the same name are all copied
+        subfolders, files = {}, []
+        if meta.get('mimeType') == G_DRIVE_DIR_MIME_TYPE:
+            parents = {meta.get('id')}
+            for file in self.walk(meta.get('id'), SYNC_FIELDS, workers):
+                parent = next(parent for parent in file.get('parents', []) if parent in parents)
+                if file.get('mimeType') == G_DRIVE_DIR_MIME_TYPE:
+                    parents.add(file.get('id'))
+                    subfolders.setdefault(parent, []).append(file)
+                else:
+                    files.append((file, parent))
+        else:
+            files.append((meta, None))
+        results = OrderedDict((dest_id, TransferResult()) for dest_id in dest_ids)
+        # Folder created in every destination for each source folder
+        folders = {dest_id: {None: dest_id} for dest_id in dest_ids}
+        size = sum(int(file.get('size') or 0) for file, _ in files)
+        self.metrics.add_total(size * len(dest_ids), len(files) * len(dest_ids))
+
+        def create_folder(dest_id, folder, parent):
+            try:
+                created = self.create_folder(folder.get('name'), folders[dest_id][parent])
+            except Exception as err:
+                results[dest_id].add_failure(folder, err)
+                return
+            folders[dest_id][folder.get('id')] = created.id
+            results[dest_id].add_folder()
+            if folder is meta:
+                results[dest_id].file = created
+            return [(create_folder, dest_id, child, folder.get('id')) for child in subfolders.get(folder.get('id'), ())]
+
+        def copy_file(dest_id, file, parent):
+            result = results[dest_id]
+            dest = folders[dest_id].get(parent)
+            try:
+                if dest is None:
+                    raise GoogleDriveError("Its folder couldn't be created.")
+                copy = self.copyFile(file.get('id'), dest, file.get('size'))
+                result.add_file(file.get('size'))
+                if file is meta:
+                    result.file = GoogleDriveFile(copy)
+            except Exception as err:
+                result.add_failure(file, err)
+            if callback:
+                callback(dest_id, result)
+
+        if meta.get('mimeType') == G_DRIVE_DIR_MIME_TYPE:
+            self.__run_tasks([(create_folder, dest_id, meta, None) for dest_id in dest_ids], workers)
+        self.__run_tasks([(copy_file, dest_id, file, parent) for file, parent in files for dest_id in dest_ids], workers)
+        for dest_id, result in results.items():
+            if result.file:
+                result.file.size = result.bytes
+            LOGGER.info(f"Cloned {name} to {dest_id}: {result}")
+        return results
+
+    # Uploads a folder with the files under threshold packed into tar shards of about
+    # shard_size, streamed while they are uploaded. Larger files are uploaded as usual
+    # into their folders. The manifest listing every shard is uploaded last.
+    def uploadPacked(self, input_directory, parent_id, workers=4, threshold=PACK_FILE_SIZE,
+                     shard_size=PACK_SHARD_SIZE):
+        result = TransferResult()
+        root = os.path.abspath(input_directory)
+        result.file = self.create_folder(os.path.basename(root), parent_id)
+        result.add_folder()
+        folders, large, shards, packed = [], [], [[]], 0
+        for directory, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            relative = os.path.relpath(directory, root).replace(os.sep, '/')
+            relative = '' if relative == '.' else relative
+            if relative:
+                folders.append(relative)
+            for filename in sorted(filenames):
+                path = os.path.join(directory, filename)
+                if not os.path.isfile(path):
+                    continue
+                size = os.path.getsize(path)
+                if size >= threshold:
+                    large.append((path, join_path(relative, filename), size))
+                    continue
+                if shards[-1] and packed + size > shard_size:
+                    shards.append([])
+                    packed = 0
+                shards[-1].append((path, join_path(relative, filename), size))
+                # Every entry has a header and is padded to 512 bytes
+                packed += size + 1024
+        shards = [shard for shard in shards if shard]
+        names = [PACK_SHARD_NAME.format(i) for i in range(len(shards))]
+        manifest = {'format': 'tar', 'folders': folders,
+                    'shards': {name: [entry[1] for entry in shard] for name, shard in zip(names, shards)}}
+        self.metrics.add_total(sum(entry[2] + 1024 for shard in shards for entry in shard) +
+                               sum(entry[2] for entry in large), len(shards) + len(large))
+        remote_folders = {'': result.file.id}
+        lock = threading.RLock()
+
+        # Only the folders holding large files are created in Drive
+        def remote_folder(path):
+            with lock:
+                if path not in remote_folders:
+                    parent, name = split_path(path)
+                    remote_folders[path] = self.create_folder(name, remote_folder(parent)).id
+                    result.add_folder()
+                return remote_folders[path]
+
+        def upload_shard(name, shard):
+            try:
+                self.upload_stream(tar_stream(shard), name, 'application/x-tar', result.file.id)
+                for entry in shard:
+                    result.add_file(entry[2])
+            except Exception as err:
+                result.add_failure({'name': name}, err)
+
+        def upload_large(path, name, size):
+            try:
+                parent, file_name = split_path(name)
+                self.upload_file(path, file_name, self.get_mime_type(path), remote_folder(parent))
+                result.add_file(size)
+            except Exception as err:
+                result.add_failure({'name': name}, err)
+
+        self.__run_tasks([(upload_shard, name, shard) for name, shard in zip(names, shards)] +
+                         [(upload_large,) + entry for entry in large], workers)
+        if not result.failures:
+            self.upload_stream(io.BytesIO(json.dumps(manifest).encode()), PACK_MANIFEST, 'application/json',
+                               result.file.id)
+        return result
+
+    # Runs (function, *args) tasks on a bounded pool of threads, a task may
+    # return more tasks which are scheduled as soon as it finishes.
+    def __run_tasks(self, tasks, workers):
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = {executor.submit(*task) for task in tasks}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    for task in future.result() or ():
+                        pending.add(executor.submit(*task))
+
     def cloneFolder(self, name, local_path, folder_id, parent_id):
         LOGGER.info(f"Syncing: {local_path}")
         files = self.getFilesByFolderId(folder_id)
@@ -281,24 +913,141 @@ class GoogleDrive:
                 current_dir = self.create_folder(file.get('name'), parent_id)
                 new_id = self.cloneFolder(file.get('name'), file_path, file.get('id'), current_dir.id)
             else:
+                self.metrics.add_total(int(file.get('size') or 0), 1)
                 try:
                     self.transferred_size += int(file.get('size'))
                 except TypeError:
                     pass
                 try:
-                    self.copyFile(file.get('id'), parent_id)
+                    self.copyFile(file.get('id'), parent_id, file.get('size'))
                     new_id = parent_id
-                except Exception as e:
-                    if isinstance(e, RetryError):
-                        LOGGER.info(f"Total Attempts: {e.last_attempt.attempt_number}")
-                        err = e.last_attempt.exception()
-                    else:
-                        err = e
+                except Exception as err:
                     LOGGER.error(err)
         return new_id
 
-    @retry(wait=wait_exponential(multiplier=2, min=3, max=6), stop=stop_after_attempt(5),
-           retry=retry_if_exception_type(HttpError), before=before_log(LOGGER, logging.DEBUG))
+    # Downloads a file or a whole folder into path, or into a folder at path if it exists.
+    # Chunks of every file are fetched by workers concurrently and written in place into a
+    # preallocated .part file, an interrupted download continues with the missing chunks.
+    # With unpack the shards of a folder uploaded with pack are extracted while they are read.
+    def download(self, file_id, path='.', workers=4, chunk_size=DOWNLOAD_CHUNK_SIZE, unpack=False):
+        meta = self.getFile(file_id)
+        if os.path.isdir(path):
+            path = os.path.join(path, local_name(meta.get('name')))
+        result = TransferResult()
+        result.file = path
+        downloads = []
+        if meta.get('mimeType') == G_DRIVE_DIR_MIME_TYPE:
+            os.makedirs(path, exist_ok=True)
+            result.add_folder()
+            entries, known = [], {meta.get('id')}
+            for file in self.walk(meta.get('id'), 'id, name, mimeType, size, md5Checksum, modifiedTime', workers):
+                parent = next(parent for parent in file.get('parents') if parent in known)
+                if file.get('mimeType') == G_DRIVE_DIR_MIME_TYPE:
+                    known.add(file.get('id'))
+                entries.append((file, parent, local_name(file.get('name'))))
+            # Siblings with the same name are told apart by their ids, the first keeps the name
+            siblings = {}
+            for file, parent, name in entries:
+                siblings.setdefault(parent, {}).setdefault(name, []).append(file.get('id'))
+            folders = {meta.get('id'): path}
+            for file, parent, name in entries:
+                ids = sorted(siblings[parent][name])
+                file_path = os.path.join(folders[parent], sibling_name(name, ids.index(file.get('id')), siblings[parent]))
+                if file.get('mimeType') == G_DRIVE_DIR_MIME_TYPE:
+                    os.makedirs(file_path, exist_ok=True)
+                    folders[file.get('id')] = file_path
+                    result.add_folder()
+                else:
+                    downloads.append(_Download(file, file_path, chunk_size))
+        else:
+            downloads.append(_Download(meta, path, chunk_size))
+        shards = []
+        manifest = next((download for download in downloads
+                         if download.path == os.path.join(path, PACK_MANIFEST)), None) if unpack else None
+        if manifest:
+            with self.open_stream(manifest.meta.get('id')) as f:
+                packed = json.load(f)
+            for folder in packed.get('folders', ()):
+                os.makedirs(os.path.join(path, *folder.split('/')), exist_ok=True)
+            shards = [download for download in downloads if os.path.dirname(download.path) == path and
+                      os.path.basename(download.path) in packed.get('shards', {})]
+            downloads = [download for download in downloads if download is not manifest and download not in shards]
+        for download in downloads + shards:
+            self.metrics.add_total(download.size, 1)
+
+        def fetch(download, index):
+            if download.failed:
+                return
+            try:
+                start, end = download.ranges[index]
+                if download.write(index, self.__download_range(download.meta.get('id'), start, end)):
+                    finish(download)
+            except Exception as err:
+                fail(download, err)
+
+        def finish(download):
+            download.finish()
+            result.add_file(download.size)
+            self.metrics.add_progress(0, 1)
+
+        def fail(download, err):
+            if download.fail():
+                LOGGER.error(f"{download.path}: {err}")
+                result.add_failure(download.meta, err)
+
+        def start(download):
+            try:
+                if download.meta.get('mimeType', '').startswith('application/vnd.google-apps.'):
+                    raise GoogleDriveError("Google Docs can't be downloaded, export them instead.")
+                if download.completed():
+                    result.add_skipped()
+                    self.metrics.add_progress(download.size, 1)
+                    return
+                missing = download.start()
+                self.metrics.add_progress(download.size - download.missing_bytes(missing))
+                if not missing:
+                    finish(download)
+                return [(fetch, download, index) for index in missing]
+            except Exception as err:
+                fail(download, err)
+
+        def extract(shard):
+            try:
+                with self.open_stream(shard.meta.get('id'), chunk_size) as f:
+                    for size in extract_tar(f, path):
+                        result.add_file(size)
+                self.metrics.add_progress(0, 1)
+            except Exception as err:
+                fail(shard, err)
+
+        self.__run_tasks([(extract, shard) for shard in shards] + [(start, download) for download in downloads], workers)
+        return result
+
+    # A file object reading the file from Drive, the next read_ahead chunks
+    # are fetched in the background while the current one is consumed
+    def open_stream(self, file_id, chunk_size=STREAM_CHUNK_SIZE, read_ahead=2):
+        meta = self.getFile(file_id)
+        if meta.get('mimeType') == G_DRIVE_DIR_MIME_TYPE:
+            raise GoogleDriveError(f"{meta.get('name')} is a folder.")
+        reader = DriveReader(lambda start, end: self.__download_range(file_id, start, end),
+                             meta, chunk_size, read_ahead)
+        return io.BufferedReader(reader, buffer_size=io.DEFAULT_BUFFER_SIZE)
+
+    def __download_range(self, file_id, start, end):
+        request = self.__service.files().get_media(supportsAllDrives=True, fileId=file_id)
+        request.headers['Range'] = f'bytes={start}-{end}'
+
+        # A short range is fetched again like a dropped connection
+        def read():
+            content = request.execute()
+            if len(content) != end - start + 1:
+                raise ConnectionError(f"Got {len(content)} bytes of range {start}-{end}")
+            return content
+
+        content = self.__execute(request, read)
+        self.metrics.add_progress(len(content))
+        return content
+
     def create_folder(self, directory_name, parent_id):
         file_metadata = {
             "name": directory_name,
@@ -306,17 +1055,10 @@ class GoogleDrive:
         }
         if parent_id is not None:
             file_metadata["parents"] = [parent_id]
-        try:
-            file = self.__service.files().create(supportsTeamDrives=True, body=file_metadata).execute()
-        except HttpError as err:
-            if err.resp.get('content-type', '').startswith('application/json'):
-                reason = json.loads(err.content).get('error').get('errors')[0].get('reason')
-                if reason == 'rateLimitExceeded':
-                    raise err
-                else:
-                    message = json.loads(err.content).get('error').get('errors')[0].get('message')
-                    raise GoogleDriveError(message) from None
+        file = self.__execute(self.__service.files().create(supportsTeamDrives=True, body=file_metadata,
+                                                            fields=self.__write_fields))
         LOGGER.info("Created Google-Drive Folder:\nName: {}".format(file.get("name")))
+        self.__index(file, parent_id)
         return GoogleDriveFile(file)
 
     def upload_dir(self, input_directory, parent_id):
@@ -332,11 +1074,472 @@ class GoogleDrive:
             else:
                 mime_type = self.get_mime_type(current_file_name)
                 file_name = current_file_name.split("/")[-1]
+                self.metrics.add_total(os.path.getsize(current_file_name), 1)
                 # current_file_name will have the full path
                 self.upload_file(current_file_name, file_name, mime_type, parent_id)
                 new_id = parent_id
         return new_id
 
+    def uploadParallel(self, input_directory, parent_id, workers=8, max_inflight_bytes=MAX_INFLIGHT_BYTES, job=None):
+        result = TransferResult()
+        root = os.path.abspath(input_directory)
+        done = self.__start_job(job, 'upload', root, parent_id)
+        folder_id = self.__job_folder(job, done, result, root, os.path.basename(root), parent_id)
+        result.file = GoogleDriveFile(self.getFile(folder_id))
+        folders = {input_directory: result.file.id}
+
+        # The folder skeleton is created first so uploads never wait on a parent.
+        def scan_folders(path, dest_id):
+            with os.scandir(path) as entries:
+                return [(create_folder, entry.path, dest_id) for entry in entries if entry.is_dir()]
+
+        def create_folder(path, dest_id):
+            try:
+                folders[path] = self.__job_folder(job, done, result, os.path.abspath(path),
+                                                  os.path.basename(path), dest_id)
+                return scan_folders(path, folders[path])
+            except Exception as err:
+                result.add_failure({'name': path}, err)
+
+        self.__run_tasks([(scan_folders, input_directory, result.file.id)], workers)
+
+        budget = _ByteBudget(max_inflight_bytes)
+        slots = threading.BoundedSemaphore(workers * 2)
+
+        def upload_file(entry, dest_id, size, cost):
+            try:
+                file = self.upload_file(entry.path, entry.name, self.get_mime_type(entry.path), dest_id)
+                result.add_file(size)
+                if job:
+                    self.jobs.done(job, os.path.abspath(entry.path), file.get('id'))
+            except Exception as err:
+                result.add_failure({'name': entry.path}, err)
+            finally:
+                budget.release(cost)
+                slots.release()
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for entry, dest_id in self.__scan_files(input_directory, folders):
+                if os.path.abspath(entry.path) in done:
+                    result.add_skipped()
+                    continue
+                size = entry.stat().st_size
+                self.metrics.add_total(size, 1)
+                slots.acquire()
+                # Multipart uploads hold the whole file in memory, resumable ones stream it from disk.
+                cost = budget.acquire(min(size, MULTIPART_UPLOAD_SIZE))
+                executor.submit(upload_file, entry, dest_id, size, cost)
+        self.__finish_job(job, result)
+        return result
+
+    def __scan_files(self, input_directory, folders):
+        stack = [input_directory]
+        while stack:
+            path = stack.pop()
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        # Skip the trees whose folder could not be created
+                        if entry.path in folders:
+                            stack.append(entry.path)
+                    else:
+                        yield entry, folders[path]
+
+    # Sends the requests built by the given factories in batches and returns
+    # a response or a GoogleDriveError for every one of them, in order. Only
+    # the failed calls whose policy retries them are sent again.
+    def batch(self, requests):
+        results = [None] * len(requests)
+        pending = list(range(len(requests)))
+        attempt = 0
+        while pending:
+            retried = {}
+
+            def callback(request_id, response, exception):
+                index = int(request_id)
+                if exception is None:
+                    results[index] = response
+                    return
+                error = classify_error(exception.resp.status, exception.content, exception.resp)
+                self.metrics.add_error(error.reason)
+                if isinstance(error, RateLimitError):
+                    limiter.throttled(WRITE)
+                policy = retry_policy(error)
+                if policy and attempt < policy.retries:
+                    retried[index] = policy.delay(attempt, error.retry_after)
+                    self.metrics.add_retry(error.reason, retried[index])
+                results[index] = error
+
+            limiter = self.rate_limiter
+            for i in range(0, len(pending), BATCH_SIZE):
+                batch = BatchHttpRequest(callback=callback, batch_uri=self.batch_uri)
+                reads = True
+                for index in pending[i:i + BATCH_SIZE]:
+                    request = requests[index]()
+                    self.__acquire(limiter, QUERY if request.method == 'GET' else WRITE)
+                    reads = reads and request.method == 'GET'
+                    batch.add(request, request_id=str(index))
+                self.__execute_batch(batch, reads)
+            pending = sorted(retried)
+            if pending:
+                LOGGER.info(f"Failed: {len(pending)} requests, Trying Again.")
+                time.sleep(max(retried.values()))
+                attempt += 1
+        return results
+
+    # Failures of a whole batch are retried, its calls are rate limited by batch()
+    def __execute_batch(self, batch, idempotent=True):
+        self.__retry(lambda: self.__send('batch', None, lambda: batch.execute(http=self.__service._http)),
+                     idempotent=idempotent)
+        if self.search_cache is not None:
+            self.search_cache.clear()
+
+    def getFiles(self, file_ids):
+        return self.batch([lambda file_id=file_id: self.__service.files().get(
+            supportsAllDrives=True, fileId=file_id, fields="name,id,mimeType,size,parents")
+            for file_id in file_ids])
+
+    def make_public_many(self, file_ids):
+        permissions = {
+            'role': 'reader',
+            'type': 'anyone',
+            'value': None,
+            'withLink': True
+        }
+        return self.batch([lambda file_id=file_id: self.__service.permissions().create(
+            supportsTeamDrives=True, fileId=file_id, body=permissions)
+            for file_id in file_ids])
+
+    def delete_many(self, file_ids, permanent=False):
+        if permanent:
+            requests = [lambda file_id=file_id: self.__service.files().delete(
+                fileId=file_id, supportsAllDrives=True) for file_id in file_ids]
+        else:
+            requests = [lambda file_id=file_id: self.__service.files().update(
+                fileId=file_id, body={'trashed': True}, supportsAllDrives=True) for file_id in file_ids]
+        responses = self.batch(requests)
+        for file_id, response in zip(file_ids, responses):
+            if not isinstance(response, GoogleDriveError):
+                self.__unindex(file_id)
+        return responses
+
+    def move_many(self, file_ids, folder=None):
+        if not folder:
+            folder = self.parent_id
+        files = self.getFiles(file_ids)
+        moves = [i for i, file in enumerate(files) if not isinstance(file, GoogleDriveError)]
+        responses = self.batch([lambda file=files[i]: self.__service.files().update(
+            fileId=file.get('id'),
+            addParents=folder,
+            removeParents=",".join(file.get('parents', [])),
+            fields=self.__write_fields or 'id,name,size,mimeType,parents',
+            supportsAllDrives=True) for i in moves])
+        for i, response in zip(moves, responses):
+            if not isinstance(response, GoogleDriveError):
+                self.__index(response, folder)
+            files[i] = response if isinstance(response, GoogleDriveError) else GoogleDriveFile(response)
+        return files
+
+    def create_folders(self, directory_names, parent_id):
+        def request(name):
+            file_metadata = {
+                "name": name,
+                "mimeType": G_DRIVE_DIR_MIME_TYPE
+            }
+            if parent_id is not None:
+                file_metadata["parents"] = [parent_id]
+            return lambda: self.__service.files().create(supportsTeamDrives=True, body=file_metadata,
+                                                         fields=self.__write_fields)
+        responses = self.batch([request(name) for name in directory_names])
+        for response in responses:
+            if not isinstance(response, GoogleDriveError):
+                self.__index(response, parent_id)
+        return [response if isinstance(response, GoogleDriveError) else GoogleDriveFile(response)
+                for response in responses]
+
+    # Transfers only the files of src, a local file or folder or a Drive folder, which
+    # are missing or changed in dest_folder. Remote entries are kept in a SyncIndex.
+    def sync(self, src, dest_folder=None, delete=False, dry_run=False, workers=None, index=None, refresh=True):
+        if not dest_folder:
+            dest_folder = self.parent_id
+        local = os.path.exists(src)
+        if not local:
+            try:
+                src_id = extractId(src)
+            except (IndexError, KeyError):
+                raise GoogleDriveError(f"{src} is neither a local path nor a Drive folder.") from None
+        if isinstance(index, str) or index is None:
+            index = SyncIndex(index or ':memory:')
+        folders, files = self.__remote_tree(dest_folder, index, refresh)
+        plan = SyncPlan(src, dest_folder, local)
+        if not local:
+            source_folders, source_files = self.__remote_tree(src_id)
+        elif os.path.isdir(src):
+            source_folders, source_files = self.__local_tree(src)
+        else:
+            # A single file, with delete only the extra copies of it are deleted
+            source_folders, source_files = {}, {os.path.basename(src): [{'path': src, 'size': os.path.getsize(src)}]}
+        plan.folders = sorted((path for path in source_folders if path not in folders),
+                              key=lambda path: path.count('/'))
+        for path, items in source_files.items():
+            transfers, extra = self.__pair(items, files.get(path, ()), plan.local, index)
+            # Files of dest which pair with none of src are extra copies
+            if delete:
+                plan.deletions.extend((remote.get('id'), path) for remote in extra)
+            elif transfers and extra:
+                plan.ambiguous.append((path, [remote.get('id') for remote in extra]))
+            for item, remote in transfers:
+                folder, name = split_path(path)
+                plan.transfers.append(SyncItem(path, item.get('path') or item.get('id'), folder, name,
+                                               int(item.get('size') or 0), remote and remote.get('id'),
+                                               item.get('md5Checksum')))
+        if delete:
+            for path, folder_id in folders.items():
+                if path and path not in source_folders and split_path(path)[0] in source_folders:
+                    plan.deletions.append((folder_id, path))
+            for path, remotes in files.items():
+                if path not in source_files and split_path(path)[0] in source_folders:
+                    plan.deletions.extend((remote.get('id'), path) for remote in remotes)
+        plan.existing, plan.index = folders, index
+        LOGGER.info(f"Sync plan: {plan}")
+        if not dry_run:
+            self.executePlan(plan, workers)
+        return plan
+
+    # Plans the clone of a file or folder into folder, matching source and
+    # destination by (relative path, size, md5Checksum) so an interrupted clone
+    # only copies what is missing. With dedupe, files with the same content
+    # anywhere below folder aren't copied again either.
+    def planClone(self, file_id, folder=None, dedupe=False, workers=4):
+        dest_folder = folder or self.parent_id
+        meta = self.getFile(file_id)
+        name = meta.get('name')
+        plan = ClonePlan(meta.get('id'), dest_folder, name)
+        if meta.get('mimeType') == G_DRIVE_DIR_MIME_TYPE:
+            source_folders, source_files = self.__walk_tree(meta.get('id'), name, workers)
+        else:
+            source_folders, source_files = {'': None}, {name: [meta]}
+        if dedupe:
+            folders, files = self.__walk_tree(dest_folder, '', workers)
+        else:
+            folders, files = {'': dest_folder}, {}
+            for child in self.getFilesByFolderId(dest_folder, SYNC_FIELDS):
+                if child.get('name') != name:
+                    continue
+                if child.get('mimeType') != G_DRIVE_DIR_MIME_TYPE:
+                    files.setdefault(name, []).append(child)
+                elif name in source_folders and name not in folders:
+                    existing_folders, existing_files = self.__walk_tree(child.get('id'), name, workers)
+                    folders.update(existing_folders)
+                    for path, remotes in existing_files.items():
+                        files.setdefault(path, []).extend(remotes)
+        plan.target = folders.get(name) or next((file.get('id') for file in files.get(name, ())), None)
+        plan.folders = sorted((path for path in source_folders if path not in folders),
+                              key=lambda path: path.count('/'))
+        contents = {(file.get('md5Checksum'), int(file.get('size') or 0)): file.get('id')
+                    for remotes in files.values() for file in remotes if file.get('md5Checksum')}
+        for path, items in source_files.items():
+            transfers, extra = self.__pair(items, files.get(path, ()), False, None)
+            if transfers and extra:
+                plan.ambiguous.append((path, [remote.get('id') for remote in extra]))
+            for item, replace in transfers:
+                duplicate = contents.get((item.get('md5Checksum'), int(item.get('size') or 0)))
+                if dedupe and replace is None and duplicate:
+                    plan.duplicates.append((path, duplicate))
+                    continue
+                parent, file_name = split_path(path)
+                plan.transfers.append(SyncItem(path, item.get('id'), parent, file_name,
+                                               int(item.get('size') or 0), replace and replace.get('id'),
+                                               item.get('md5Checksum')))
+        plan.existing, plan.index = folders, SyncIndex()
+        LOGGER.info(f"Clone plan: {plan}")
+        return plan
+
+    # Runs a plan of sync or planClone, plan.result gets the TransferResult
+    def executePlan(self, plan, workers=None):
+        plan.result = self.__execute_sync(plan, plan.existing, plan.index, workers)
+        if isinstance(plan, ClonePlan):
+            target = plan.existing.get(plan.name) or plan.target
+            if target is None and plan.transfers:
+                target = plan.transfers[0].copied
+            if target:
+                plan.result.file = GoogleDriveFile(self.getFile(target))
+                plan.result.file.size = plan.result.bytes
+        return plan
+
+    # Relative paths of everything below folder_id, prefixed with root. Drive allows
+    # siblings with the same name, every path maps to the list of its files.
+    def __walk_tree(self, folder_id, root='', workers=4):
+        folders, files = {root: folder_id}, {}
+        paths = {folder_id: root}
+        for file in self.walk(folder_id, SYNC_FIELDS, workers):
+            parent = next(parent for parent in file.get('parents', []) if parent in paths)
+            path = join_path(paths[parent], file.get('name'))
+            if file.get('mimeType') == G_DRIVE_DIR_MIME_TYPE:
+                folders[path] = file.get('id')
+                paths[file.get('id')] = path
+            else:
+                files.setdefault(path, []).append(file)
+        return folders, files
+
+    # Drive allows several files with the same path, those of src and dest are paired by
+    # size and md5. The one file of src left replaces the one file of dest left, else
+    # the files left are transferred as new. Returns the (item, replaced file) pairs to
+    # transfer and the files of dest paired with none.
+    def __pair(self, items, remotes, local, index):
+        remotes = list(remotes)
+        left = []
+        for item in items:
+            remote = next((remote for remote in remotes if not self.__changed(item, remote, local, index)), None)
+            if remote is None:
+                left.append(item)
+            else:
+                remotes.remove(remote)
+        if len(left) == 1 and len(remotes) == 1:
+            return [(left[0], remotes[0])], []
+        return [(item, None) for item in left], remotes
+
+    def __changed(self, item, remote, local, index):
+        # Google Docs have neither size nor checksum, they are only copied when missing
+        if not local and item.get('md5Checksum') is None:
+            return False
+        if remote.get('size') is None or int(remote.get('size')) != int(item.get('size') or 0):
+            return True
+        md5 = index.hashes.md5(item['path']) if local else item.get('md5Checksum')
+        return md5 != remote.get('md5Checksum')
+
+    def __execute_sync(self, plan, folders, index, workers):
+        result = TransferResult()
+        self.metrics.add_total(plan.bytes, len(plan.transfers))
+        for path in plan.folders:
+            parent, name = split_path(path)
+            folder = self.create_folder(name, folders[parent])
+            folders[path] = folder.id
+            index.put({'id': folder.id, 'name': name, 'mimeType': G_DRIVE_DIR_MIME_TYPE}, folders[parent])
+            result.add_folder()
+
+        def transfer(item):
+            try:
+                parent_id = folders[item.folder]
+                if plan.local:
+                    file = self.upload_file(item.source, item.name, self.get_mime_type(item.source), parent_id, item.file_id)
+                    md5 = index.hashes.md5(item.source)
+                else:
+                    file = self.copyFile(item.source, parent_id, item.size)
+                    # A copy can't replace the content of a file, the outdated one is trashed
+                    if item.file_id:
+                        self.delete(item.file_id)
+                        index.remove(item.file_id)
+                    # A copy has the content of its source
+                    md5 = item.md5
+                index.put({'id': file.get('id'), 'name': item.name, 'size': item.size,
+                           'md5Checksum': md5}, parent_id)
+                item.copied = file.get('id')
+                result.add_file(item.size)
+            except Exception as err:
+                result.add_failure({'name': item.path}, err)
+
+        with ThreadPoolExecutor(max_workers=workers or 1) as executor:
+            list(executor.map(transfer, plan.transfers))
+        if plan.deletions:
+            responses = self.delete_many([file_id for file_id, _ in plan.deletions])
+            for (file_id, path), response in zip(plan.deletions, responses):
+                if isinstance(response, GoogleDriveError):
+                    result.add_failure({'name': path}, response)
+                else:
+                    index.remove(file_id)
+        return result
+
+    def __remote_tree(self, folder_id, index=None, refresh=True):
+        folders = {'': folder_id}
+        files = {}
+        pending = ['']
+        while pending:
+            path = pending.pop()
+            children = None if refresh or index is None else index.children(folders[path])
+            if children is None:
+                children = self.getFilesByFolderId(folders[path], SYNC_FIELDS)
+                if index is not None:
+                    index.replace_children(folders[path], children)
+            for child in children:
+                child_path = join_path(path, child.get('name'))
+                if child.get('mimeType') == G_DRIVE_DIR_MIME_TYPE:
+                    folders[child_path] = child.get('id')
+                    pending.append(child_path)
+                else:
+                    files.setdefault(child_path, []).append(child)
+        return folders, files
+
+    def __local_tree(self, input_directory):
+        folders = {'': input_directory}
+        files = {}
+        pending = ['']
+        while pending:
+            path = pending.pop()
+            with os.scandir(folders[path]) as entries:
+                for entry in entries:
+                    entry_path = join_path(path, entry.name)
+                    if entry.is_dir():
+                        folders[entry_path] = entry.path
+                        pending.append(entry_path)
+                    else:
+                        files[entry_path] = [{'path': entry.path, 'size': entry.stat().st_size}]
+        return folders, files
+
+    # Brings the tree cache up to date through the changes feed, at most once
+    # per poll interval unless forced. The first update lists the whole drive.
+    def updateTreeCache(self, force=False):
+        cache = self.tree_cache
+        if not force and time.time() - cache.polled < cache.poll_interval:
+            return cache
+        # Threads finding another one polling keep working with the current state
+        if not cache.polling.acquire(blocking=force):
+            return cache
+        try:
+            if cache.page_token is None:
+                LOGGER.info("Building the tree cache")
+                token = self.__changes_request('getStartPageToken', driveId=cache.drive_id)['startPageToken']
+                root_id = cache.drive_id or self.__execute(self.__service.files().get(fileId='root', fields='id'))['id']
+                cache.bootstrap(self.__list_drive(cache.drive_id), token, root_id)
+            else:
+                token = cache.page_token
+                while token:
+                    response = self.__changes_request('list', pageToken=token, driveId=cache.drive_id,
+                                                      includeItemsFromAllDrives=True, pageSize=1000,
+                                                      fields=f'nextPageToken, newStartPageToken, '
+                                                             f'changes(fileId, removed, file({TREE_CACHE_FIELDS}))')
+                    cache.apply(response.get('changes', []))
+                    token = response.get('nextPageToken')
+                    cache.page_token = token or response.get('newStartPageToken')
+            cache.polled = time.time()
+            cache.save()
+        finally:
+            cache.polling.release()
+        return cache
+
+    def __tree_cache(self):
+        return self.updateTreeCache() if self.tree_cache is not None else None
+
+    def __list_drive(self, drive_id=None):
+        kwargs = {'corpora': 'drive', 'driveId': drive_id} if drive_id else {}
+        page_token = None
+        while True:
+            response = self.__list_page(q="trashed = false", pageSize=1000, pageToken=page_token,
+                                        fields=f'nextPageToken, files({TREE_CACHE_FIELDS})', **kwargs)
+            yield from response.get('files', [])
+            page_token = response.get('nextPageToken')
+            if page_token is None:
+                break
+
+    def __list_page(self, **kwargs):
+        return self.__execute(self.__service.files().list(supportsAllDrives=True, includeItemsFromAllDrives=True,
+                                                          spaces='drive', **kwargs))
+
+    def __changes_request(self, method, driveId=None, **kwargs):
+        if driveId:
+            kwargs['driveId'] = driveId
+        return self.__execute(getattr(self.__service.changes(), method)(supportsAllDrives=True, **kwargs))
+
     def authorize(self, token):
         credentials = None
         if isinstance(token, OAuth2Credentials):
@@ -354,15 +1557,13 @@ class GoogleDrive:
                 with open(token, 'wb') as token:
                     pickle.dump(credentials, token)
             else:
-                status = parse_service_accounts(token)
-                if status:
-                    credentials = service_account.Credentials.from_service_account_file(
-                        f'{token}/{self.__SERVICE_ACCOUNT_INDEX}.json',
-                        scopes=OAUTH_SCOPE)
-                    self.__USE_SERVICE_ACCOUNTS = True
+                self.__pool = ServiceAccountPool.load(token)
+                self.__USE_SERVICE_ACCOUNTS = True
+                return self.__account.service(self.transport)
         else:
             raise GoogleDriveError("InvalidCredentials: Invalid credentials provided.")
-        return build('drive', 'v3', credentials=credentials, cache_discovery=False)
+        self.__credentials = credentials
+        return build_service(credentials, self.transport)
 
     def escapes(self, str):
         chars = ['\\', "'", '"', r'\a', r'\b', r'\f', r'\n', r'\r', r'\t']
@@ -371,89 +1572,398 @@ class GoogleDrive:
         return str
 
     def get_mime_type(self, file_path):
-        mime_type = guess_type(file_path)
-        return mime_type if mime_type[0] else "text/plain"
+        mime_type = guess_type(file_path)[0]
+        return mime_type if mime_type else "text/plain"
 
 
-    def search(self, fileName, folder=None, limit=20, next_page_token=None):
+    def search(self, fileName, folder=None, limit=20, next_page_token=None, fields='id, name, mimeType, size'):
+        cache = self.__tree_cache()
+        if cache is not None and (folder is None or cache.has_folder(folder)):
+            files, next_page_token = cache.search(str(fileName), folder, limit, next_page_token)
+            return [GoogleDriveFile(file) for file in files], next_page_token
+        index = self.name_index
+        if index is not None and folder and index.has_folder(folder):
+            files, next_page_token = index.search(str(fileName), folder, limit, next_page_token)
+            return [GoogleDriveFile(file) for file in files], next_page_token
+        key = (str(fileName), folder, limit, next_page_token, fields)
+        cached = self.search_cache.get(key) if self.search_cache is not None else None
+        if cached is not None:
+            return [GoogleDriveFile(file) for file in cached[0]], cached[1]
         files = []
-        fileName = self.escapes(str(fileName))
-        # Create Search Query for API request.
-        query = f"(name contains '{fileName}')"
-        if folder:
-          query += f"and '{folder}' in parents"
-        response = self.__service.files().list(supportsTeamDrives=True,
+        response = self.__execute(self.__service.files().list(supportsTeamDrives=True,
                                                includeTeamDriveItems=True,
-                                               q=query,
+                                               q=self.__search_query(fileName, folder),
                                                spaces='drive',
                                                pageSize=limit,
-                                               fields='nextPageToken, files(id, name, mimeType, size)',
+                                               fields=f'nextPageToken, files({fields})',
                                                orderBy='modifiedTime desc',
-                                               pageToken=next_page_token).execute()
+                                               pageToken=next_page_token))
+        if self.search_cache is not None:
+            self.search_cache.put(key, (response.get('files', []), response.get("nextPageToken")))
         for file in response.get('files', []):
             files.append(GoogleDriveFile(file))
         return files, response.get("nextPageToken")
 
-    @retry(wait=wait_exponential(multiplier=2, min=3, max=6), stop=stop_after_attempt(3),
-        retry=retry_if_exception_type(HttpError), before=before_log(LOGGER, logging.DEBUG))
-    def delete(self, file_id: str, permanent=False):
-        try:
-            if permanent:
-                response = self.__service.files().delete(fileId=file_id, supportsAllDrives=True).execute()
+    # Yields every match of search(), following nextPageToken as the items are
+    # consumed, so only one page is held in memory whatever the number of results
+    def iter_search(self, fileName, folder=None, fields='id, name, mimeType, size', page_size=LIST_PAGE_SIZE):
+        cache = self.__tree_cache()
+        index = self.name_index
+        next_page_token = None
+        while True:
+            if cache is not None and (folder is None or cache.has_folder(folder)):
+                files, next_page_token = cache.search(str(fileName), folder, page_size, next_page_token)
+            elif index is not None and folder and index.has_folder(folder):
+                files, next_page_token = index.search(str(fileName), folder, page_size, next_page_token)
             else:
-                response = self.__service.files().update(fileId=file_id, body={'trashed': True}, supportsAllDrives=True).execute()
-            return response
-        except HttpError as err:
-            if err.resp.get('content-type', '').startswith('application/json'):
-                reason = json.loads(err.content).get('error').get('errors')[0].get('reason')
-                if reason == "rateLimitExceeded":
-                    raise err
-                else:
-                    message = json.loads(err.content).get('error').get('errors')[0].get('message')
-                    raise GoogleDriveError(message) from None
+                response = self.__list_page(q=self.__search_query(fileName, folder), pageSize=page_size,
+                                            fields=f'nextPageToken, files({fields})', orderBy='modifiedTime desc',
+                                            pageToken=next_page_token)
+                files, next_page_token = response.get('files', []), response.get('nextPageToken')
+            for file in files:
+                yield GoogleDriveFile(file)
+            if not next_page_token:
+                return
+
+    # Indexes the names below a folder, searches in any folder of the tree are
+    # then answered locally, index.search() searches the whole tree
+    def buildNameIndex(self, folder_id, workers=4):
+        index = NameIndex(folder_id)
+        for file in self.walk(folder_id, 'id, name, mimeType, size, parents, modifiedTime', workers):
+            index.add(file)
+        self.name_index = index
+        return index
+
+    def __search_query(self, fileName, folder=None):
+        # Create Search Query for API request.
+        query = f"(name contains '{self.escapes(str(fileName))}')"
+        if folder:
+            query += f"and '{folder}' in parents"
+        return query
+
+    def delete(self, file_id: str, permanent=False):
+        if permanent:
+            response = self.__execute(self.__service.files().delete(fileId=file_id, supportsAllDrives=True))
+        else:
+            response = self.__execute(self.__service.files().update(fileId=file_id, body={'trashed': True}, supportsAllDrives=True))
+        self.__unindex(file_id)
+        return response
 
-    @retry(wait=wait_exponential(multiplier=2, min=3, max=6), stop=stop_after_attempt(3),
-        retry=retry_if_exception_type(HttpError), before=before_log(LOGGER, logging.DEBUG))
     def emptyTrash(self):
-        try:
-            return self.__service.files().emptyTrash().execute()
-        except HttpError as err:
-            if err.resp.get('content-type', '').startswith('application/json'):
-                reason = json.loads(err.content).get('error').get('errors')[0].get('reason')
-                if reason == "rateLimitExceeded":
-                    raise err
-                else:
-                    message = json.loads(err.content).get('error').get('errors')[0].get('message')
-                    raise GoogleDriveError(message) from None
+        return self.__execute(self.__service.files().emptyTrash())
 
-    @retry(wait=wait_exponential(multiplier=2, min=3, max=6), stop=stop_after_attempt(3),
-        retry=retry_if_exception_type(HttpError), before=before_log(LOGGER, logging.DEBUG))
     def move(self, file_id, folder=False):
         if not folder:
             folder = self.parent_id
         file = self.getFile(file_id)
         previous_parents = ",".join(file.get('parents'))
-        try:
-            file = self.__service.files().update(
-                fileId=file_id,
-                addParents=folder,
-                removeParents=previous_parents,
-                fields='id,name,size,mimeType,parents',
-                supportsAllDrives=True,
-            ).execute()
-        except HttpError as err:
-            if err.resp.get('content-type', '').startswith('application/json'):
-                reason = json.loads(err.content).get('error').get('errors')[0].get('reason')
-                if reason == "rateLimitExceeded":
-                    raise err
-                else:
-                    message = json.loads(err.content).get('error').get('errors')[0].get('message')
-                    raise GoogleDriveError(message) from None
+        file = self.__execute(self.__service.files().update(
+            fileId=file_id,
+            addParents=folder,
+            removeParents=previous_parents,
+            fields=self.__write_fields or 'id,name,size,mimeType,parents',
+            supportsAllDrives=True,
+        ))
+        self.__index(file, folder)
+        return GoogleDriveFile(file)
+
+
+
+# Same operations as GoogleDrive on asyncio and aiohttp. Requests share one
+# pooled keep-alive connector, and cancelling the task of an upload stops it
+# mid-chunk and discards the upload session.
+class AsyncGoogleDrive:
+    def __init__(self, token, workdir=None, rate_limiter=None, connections=100, metrics=None):
+        _load()
+        _load_async()
+        if aiohttp is None:
+            raise GoogleDriveError("AsyncGoogleDrive requires aiohttp, install it with: pip install gdnan[async]")
+        if isinstance(token, str) and os.path.isdir(token):
+            self.__credentials = ServiceAccountPool.load(token).acquire().credentials
+        elif isinstance(token, str) and os.path.isfile(token):
+            with open(token, 'rb') as f:
+                self.__credentials = pickle.load(f)
+        elif isinstance(token, OAuth2Credentials):
+            self.__credentials = token
+        else:
+            raise GoogleDriveError("InvalidCredentials: Invalid credentials provided.")
+        self.rate_limiter = rate_limiter or RateLimiter.shared(self.__credentials)
+        self.metrics = metrics or TransferMetrics()
+        self.connections = connections
+        self.parent_id = extractId(workdir) if workdir else "root"
+        self.__session = None
+        self.__access_token = None
+        self.__refresh_lock = None
+        document = discovery_document()
+        self.api_uri = document['rootUrl'] + document['servicePath']
+        self.upload_uri = document['rootUrl'] + 'upload/' + document['servicePath']
+
+    escapes = GoogleDrive.escapes
+    get_mime_type = GoogleDrive.get_mime_type
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        if self.__session is not None:
+            await self.__session.close()
+            self.__session = None
+
+    async def __headers(self, headers=None, refresh=False):
+        if self.__refresh_lock is None:
+            self.__refresh_lock = asyncio.Lock()
+        if refresh or self.__access_token is None or access_token_expired(self.__credentials):
+            async with self.__refresh_lock:
+                loop = asyncio.get_event_loop()
+                self.__access_token = await loop.run_in_executor(None, refresh_access_token,
+                                                                 self.__credentials, refresh)
+        return dict(headers or {}, Authorization=f'Bearer {self.__access_token}')
+
+    # Failures are retried by the same policies as GoogleDrive, see RETRY_POLICIES. Calls
+    # other than GET are idempotent only if told so, like the chunks of an upload session.
+    async def __request(self, method, url, params=None, json=None, data=None, headers=None, retry=True, name=None,
+                        idempotent=None):
+        name = name or method
+        idempotent = method == 'GET' if idempotent is None else idempotent
+        if self.__session is None:
+            self.__session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.connections))
+        kind = QUERY if method == 'GET' else WRITE
+        refresh = refreshed = False
+        attempt = 0
+        while True:
+            delay = self.rate_limiter.reserve(kind)
+            if delay:
+                self.metrics.add_wait(kind, delay)
+                await asyncio.sleep(delay)
+            start = time.time()
+            try:
+                async with self.__session.request(method, url, params=params, json=json, data=data,
+                                                  headers=await self.__headers(headers, refresh),
+                                                  allow_redirects=False) as response:
+                    content = await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                self.metrics.add_request(name, time.time() - start, type(err).__name__)
+                error = network_error(err)
+            else:
+                if response.status < 300 or response.status == 308:
+                    self.metrics.add_request(name, time.time() - start)
+                    self.rate_limiter.succeeded(kind)
+                    return response, content
+                error = classify_error(response.status, content, response.headers)
+                self.metrics.add_request(name, time.time() - start, error.reason)
+                if isinstance(error, RateLimitError):
+                    self.rate_limiter.throttled(kind)
+            # An expired token is refreshed once and the request sent again right away
+            refresh = error.status == 401 and not refreshed
+            if refresh:
+                refreshed = True
+                continue
+            policy = retry_policy(error, idempotent) if retry else None
+            if policy is None or attempt >= policy.retries:
+                raise error
+            delay = policy.delay(attempt, error.retry_after)
+            self.metrics.add_retry(error.reason, delay)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def __json(self, method, path, params=None, **kwargs):
+        params = dict(params or {}, supportsAllDrives='true')
+        name = method + ' ' + re.sub(r'^files/[^/]+', 'files/{id}', path)
+        response, content = await self.__request(method, self.api_uri + path, params, name=name, **kwargs)
+        return json.loads(content) if content else None
+
+    async def getFile(self, file_id):
+        return await self.__json('GET', f'files/{file_id}', {'fields': 'name,id,mimeType,size,parents'})
+
+    async def getFilesByFolderId(self, folder_id, fields='id, name, mimeType, size'):
+        files = []
+        params = {'q': f"'{folder_id}' in parents and trashed = false", 'pageSize': str(LIST_PAGE_SIZE),
+                  'includeItemsFromAllDrives': 'true', 'fields': f'nextPageToken, files({fields})'}
+        while True:
+            response = await self.__json('GET', 'files', params)
+            files.extend(response.get('files', []))
+            if not response.get('nextPageToken'):
+                return files
+            params['pageToken'] = response['nextPageToken']
+
+    async def create_folder(self, directory_name, parent_id):
+        file_metadata = {
+            "name": directory_name,
+            "mimeType": G_DRIVE_DIR_MIME_TYPE
+        }
+        if parent_id is not None:
+            file_metadata["parents"] = [parent_id]
+        file = await self.__json('POST', 'files', json=file_metadata)
+        LOGGER.info("Created Google-Drive Folder:\nName: {}".format(file.get("name")))
+        return GoogleDriveFile(file)
+
+    async def make_public(self, drive_id):
+        permissions = {
+            'role': 'reader',
+            'type': 'anyone',
+            'withLink': True
+        }
+        return await self.__json('POST', f'files/{drive_id}/permissions', json=permissions)
+
+    async def move(self, file_id, folder=False):
+        if not folder:
+            folder = self.parent_id
+        file = await self.getFile(file_id)
+        return GoogleDriveFile(await self.__json('PATCH', f'files/{file_id}', json={}, params={
+            'addParents': folder, 'removeParents': ",".join(file.get('parents')),
+            'fields': 'id,name,size,mimeType,parents'}))
+
+    async def delete(self, file_id, permanent=False):
+        if permanent:
+            return await self.__json('DELETE', f'files/{file_id}')
+        return await self.__json('PATCH', f'files/{file_id}', json={'trashed': True})
+
+    async def emptyTrash(self):
+        return await self.__json('DELETE', 'files/trash')
+
+    async def search(self, fileName, folder=None, limit=20, next_page_token=None, fields='id, name, mimeType, size'):
+        fileName = self.escapes(str(fileName))
+        query = f"(name contains '{fileName}')"
+        if folder:
+            query += f"and '{folder}' in parents"
+        params = {'q': query, 'pageSize': str(limit), 'orderBy': 'modifiedTime desc', 'includeItemsFromAllDrives': 'true',
+                  'fields': f'nextPageToken, files({fields})'}
+        if next_page_token:
+            params['pageToken'] = next_page_token
+        response = await self.__json('GET', 'files', params)
+        return [GoogleDriveFile(file) for file in response.get('files', [])], response.get("nextPageToken")
+
+    async def iter_search(self, fileName, folder=None, fields='id, name, mimeType, size', page_size=LIST_PAGE_SIZE):
+        next_page_token = None
+        while True:
+            files, next_page_token = await self.search(fileName, folder, page_size, next_page_token, fields)
+            for file in files:
+                yield file
+            if not next_page_token:
+                return
+
+    # Copies a file or a whole folder, at most `workers` calls are in flight
+    async def clone(self, file_id, folder=None, workers=8):
+        parent_id = folder or self.parent_id
+        if file_id == parent_id:
+            raise GoogleDriveError("Can't clone the working directory in itself.")
+        meta = await self.getFile(file_id)
+        file = await self.__clone(meta, parent_id, asyncio.Semaphore(workers))
+        LOGGER.info("Cloned: " + file.name)
+        return file
+
+    async def __clone(self, meta, parent_id, slots):
+        if meta.get('mimeType') != G_DRIVE_DIR_MIME_TYPE:
+            self.metrics.add_total(int(meta.get('size') or 0), 1)
+            async with slots:
+                file = GoogleDriveFile(await self.__json('POST', f"files/{meta['id']}/copy", json={'parents': [parent_id]}))
+            self.metrics.add_progress(int(meta.get('size') or 0), 1)
+            return file
+        async with slots:
+            folder = await self.create_folder(meta.get('name'), parent_id)
+            children = await self.getFilesByFolderId(meta['id'])
+        await asyncio.gather(*(self.__clone(child, folder.id, slots) for child in children))
+        return folder
+
+    # Uploads a file, a folder or a binary stream, folders are uploaded `workers` files at a time
+    async def upload(self, file_path, folder=None, name=None, workers=4):
+        parent_id = folder or self.parent_id
+        if isinstance(file_path, (str, os.PathLike)):
+            file_path = os.fspath(file_path)
+        else:
+            name = name or os.path.basename(str(getattr(file_path, 'name', '')))
+            if not name:
+                raise GoogleDriveError("A name is required to upload a stream.")
+            return GoogleDriveFile(await self.upload_stream(file_path, name, self.get_mime_type(name), parent_id))
+        if os.path.isdir(file_path):
+            return await self.__upload_dir(file_path, parent_id, asyncio.Semaphore(workers))
+        if not os.path.isfile(file_path):
+            raise GoogleDriveError(f"File or folder '{file_path}' doesn't exist.")
+        LOGGER.info("Uploading File: " + file_path)
+        self.metrics.add_total(os.path.getsize(file_path), 1)
+        with open(file_path, 'rb') as f:
+            file = await self.upload_stream(f, name or os.path.basename(file_path), self.get_mime_type(file_path),
+                                            parent_id, os.fstat(f.fileno()).st_size)
+        LOGGER.info("Uploaded To G-Drive: " + file_path)
         return GoogleDriveFile(file)
 
+    async def __upload_dir(self, path, parent_id, slots):
+        async with slots:
+            folder = await self.create_folder(os.path.basename(path.rstrip(os.sep)), parent_id)
+        async def upload(entry):
+            if entry.is_dir():
+                return await self.__upload_dir(entry.path, folder.id, slots)
+            async with slots:
+                return await self.upload(entry.path, folder.id)
+        with os.scandir(path) as entries:
+            await asyncio.gather(*(upload(entry) for entry in entries))
+        return folder
+
+    async def upload_stream(self, stream, file_name, mime_type, parent_id, size=None):
+        loop = asyncio.get_event_loop()
+        file_metadata = {
+            'name': file_name,
+            'description': 'uploaded by gdnan',
+            'mimeType': mime_type,
+            'parents': [parent_id]
+        }
+        params = {'supportsAllDrives': 'true', 'fields': 'id, name, mimeType, size, parents'}
+        if size is not None and size <= MULTIPART_UPLOAD_SIZE:
+            with aiohttp.MultipartWriter('related') as body:
+                body.append_json(file_metadata)
+                body.append(await loop.run_in_executor(None, stream.read), {'Content-Type': mime_type})
+            response, content = await self.__request('POST', self.upload_uri + 'files',
+                                                     dict(params, uploadType='multipart'), data=body, name='upload')
+            self.metrics.add_progress(int(json.loads(content).get('size') or 0), 1)
+            return json.loads(content)
+        headers = {'X-Upload-Content-Type': mime_type}
+        if size is not None:
+            headers['X-Upload-Content-Length'] = str(size)
+        # Starting a session creates no file yet
+        response, _ = await self.__request('POST', self.upload_uri + 'files', dict(params, uploadType='resumable'),
+                                           json=file_metadata, headers=headers, name='upload', idempotent=True)
+        upload_uri = response.headers['Location']
+        try:
+            return await self.__upload_chunks(stream, upload_uri, loop)
+        except asyncio.CancelledError:
+            LOGGER.info(f"Upload of {file_name} cancelled")
+            # A DELETE on the session frees it right away instead of after a week
+            try:
+                await asyncio.wait_for(self.__request('DELETE', upload_uri, retry=False, name='upload:cancel'), 10)
+            except (GoogleDriveError, aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+            raise
 
+    async def __upload_chunks(self, stream, upload_uri, loop):
+        sizer = ChunkSizer()
+        data, offset, total = b'', 0, '*'
+        while True:
+            if total == '*' and len(data) < sizer.chunksize:
+                chunk = await loop.run_in_executor(None, stream.read, sizer.chunksize - len(data))
+                data += chunk
+                if len(data) < sizer.chunksize:
+                    total = str(offset + len(data))
+            body = data[:sizer.chunksize]
+            content_range = f'bytes {offset}-{offset + len(body) - 1}/{total}' if body else f'bytes */{total}'
+            start = time.time()
+            response, content = await self.__request('PUT', upload_uri, data=body, name='upload:chunk',
+                                                     headers={'Content-Range': content_range}, idempotent=True)
+            if response.status != 308:
+                self.metrics.add_progress(len(body), 1)
+                return json.loads(content)
+            # The server may keep less than it was sent, the rest goes again
+            committed = int(response.headers['Range'].rsplit('-', 1)[1]) + 1 if 'Range' in response.headers else 0
+            sizer.update(committed - offset, time.time() - start)
+            self.metrics.add_progress(committed - offset)
+            data, offset = data[committed - offset:], committed
 
+# Slots instead of a __dict__ and the url formatted on access, millions of them stay small
 class GoogleDriveFile:
+    __slots__ = ('id', 'name', 'mimeType', 'size', 'driveId', 'teamDriveId', 'kind')
+
     def __init__(self, file):
         self.id = file.get('id')
         self.name = file.get('name')
@@ -462,10 +1972,1127 @@ class GoogleDriveFile:
         self.driveId = file.get('driveId')
         self.teamDriveId = file.get('teamDriveId')
         self.kind = file.get('kind')
-        self.url = create_link(self.id, self.mimeType)
+
+    @property
+    def url(self):
+        return create_link(self.id, self.mimeType)
+
+class TransferResult:
+    def __init__(self):
+        self.file = None
+        self.files = 0
+        self.folders = 0
+        self.bytes = 0
+        self.skipped = 0
+        self.failures = []
+        self.__lock = threading.Lock()
+
+    # Items a resumed job had already finished
+    def add_skipped(self):
+        with self.__lock:
+            self.skipped += 1
+
+    def add_file(self, size):
+        with self.__lock:
+            self.files += 1
+            self.bytes += int(size or 0)
+
+    def add_folder(self):
+        with self.__lock:
+            self.folders += 1
+
+    def add_failure(self, file, err):
+        LOGGER.error(f"{file.get('name')}: {err}")
+        with self.__lock:
+            self.failures.append((file, str(err)))
+
+    def __repr__(self):
+        return (f"<TransferResult files={self.files} folders={self.folders} bytes={self.bytes} "
+                f"skipped={self.skipped} failures={len(self.failures)}>")
+
+# Local copy of the tree of a drive or shared drive kept current through the
+# changes feed, lookups by id and by (parent, name) don't need any API call.
+class DriveTreeCache:
+    def __init__(self, path=None, drive_id=None, poll_interval=10):
+        self.path = path
+        self.drive_id = drive_id
+        self.poll_interval = poll_interval
+        self.polled = 0
+        self.polling = threading.Lock()
+        self.page_token = None
+        self.root_id = None
+        self.files = {}
+        self.__children = {}
+        self.__names = {}
+        self.__sizes = {}
+        self.__lock = threading.RLock()
+        if path and os.path.isfile(path):
+            with open(path, 'rb') as f:
+                state = pickle.load(f)
+            if state['drive_id'] == drive_id:
+                self.page_token, self.root_id = state['page_token'], state['root_id']
+                for file in state['files'].values():
+                    self.__put(file)
+
+    def __contains__(self, file_id):
+        return self.__resolve(file_id) in self.files
+
+    def __len__(self):
+        return len(self.files)
+
+    def __resolve(self, file_id):
+        return self.root_id if file_id == 'root' else file_id
+
+    def bootstrap(self, files, page_token, root_id):
+        with self.__lock:
+            self.files, self.__children, self.__names, self.__sizes = {}, {}, {}, {}
+            self.root_id = root_id
+            for file in files:
+                self.__put(file)
+            self.page_token = page_token
+
+    def apply(self, changes):
+        with self.__lock:
+            self.__sizes = {}
+            for change in changes:
+                file = change.get('file')
+                self.__remove(change.get('fileId'))
+                if not change.get('removed') and file and not file.get('trashed'):
+                    self.__put(file)
+
+    def __put(self, file):
+        self.__remove(file['id'])
+        if 'root' in file.get('parents', ()):
+            file = dict(file, parents=[self.__resolve(parent) for parent in file['parents']])
+        self.files[file['id']] = file
+        for parent in file.get('parents', []):
+            self.__children.setdefault(parent, set()).add(file['id'])
+            self.__names[(parent, file.get('name'))] = file['id']
+
+    def __remove(self, file_id):
+        file = self.files.pop(file_id, None)
+        if file is None:
+            return
+        for parent in file.get('parents', []):
+            self.__children.get(parent, set()).discard(file_id)
+            if self.__names.get((parent, file.get('name'))) == file_id:
+                del self.__names[(parent, file.get('name'))]
+
+    def get(self, file_id):
+        with self.__lock:
+            file = self.files.get(self.__resolve(file_id))
+            return dict(file) if file else None
+
+    def find(self, parent, name):
+        with self.__lock:
+            return self.get(self.__names.get((self.__resolve(parent), name)))
+
+    def has_folder(self, folder_id):
+        folder_id = self.__resolve(folder_id)
+        return folder_id == self.root_id or (folder_id in self.files and
+                                             self.files[folder_id].get('mimeType') == G_DRIVE_DIR_MIME_TYPE)
+
+    def children(self, folder_id):
+        with self.__lock:
+            return [dict(self.files[file_id]) for file_id in self.__children.get(self.__resolve(folder_id), ())]
+
+    # Total size of the files below a folder, kept until the next change
+    def subtree_size(self, folder_id):
+        folder_id = self.__resolve(folder_id)
+        with self.__lock:
+            if folder_id not in self.__sizes:
+                size, pending = 0, [folder_id]
+                while pending:
+                    for child in self.__children.get(pending.pop(), ()):
+                        file = self.files[child]
+                        if file.get('mimeType') == G_DRIVE_DIR_MIME_TYPE:
+                            pending.append(child)
+                        else:
+                            size += int(file.get('size') or 0)
+                self.__sizes[folder_id] = size
+            return self.__sizes[folder_id]
+
+    def search(self, name, folder=None, limit=20, next_page_token=None):
+        name = name.lower()
+        with self.__lock:
+            files = self.children(folder) if folder else list(self.files.values())
+        files = sorted((file for file in files if name in file.get('name', '').lower()),
+                       key=lambda file: file.get('modifiedTime', ''), reverse=True)
+        start = int(next_page_token or 0)
+        next_page_token = str(start + limit) if start + limit < len(files) else None
+        return files[start:start + limit], next_page_token
+
+    def save(self):
+        if not self.path:
+            return
+        with self.__lock:
+            state = {'drive_id': self.drive_id, 'page_token': self.page_token,
+                     'root_id': self.root_id, 'files': self.files}
+            with open(self.path + '.tmp', 'wb') as f:
+                pickle.dump(state, f)
+        os.replace(self.path + '.tmp', self.path)
+
+# Results of search() kept for ttl seconds, the least recently used are dropped
+# above size entries. The client clears it whenever it changes anything.
+class SearchCache:
+    def __init__(self, size=1024, ttl=300):
+        self.size = size
+        self.ttl = ttl
+        self.hits = self.misses = 0
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get(self, key):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry and time.monotonic() - entry[0] <= self.ttl:
+                self.__entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.__entries.pop(key, None)
+            self.misses += 1
+
+    def put(self, key, value):
+        with self.__lock:
+            self.__entries[key] = (time.monotonic(), value)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.size:
+                self.__entries.popitem(last=False)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+# Trigram index of the names in a folder tree. A substring search only looks at the
+# names sharing all trigrams of the query, queries under 3 characters scan every name.
+class NameIndex:
+    def __init__(self, root=None):
+        self.root = root
+        self.files = {}
+        self.__children = {root: set()} if root else {}
+        self.__grams = {}
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.files)
+
+    def has_folder(self, folder_id):
+        return folder_id in self.__children
+
+    # Adds, renames or moves an entry, one moved out of the tree is removed
+    def add(self, file):
+        with self.__lock:
+            parents = [parent for parent in file.get('parents') or () if parent in self.__children]
+            if not parents:
+                self.__remove(file['id'])
+                return
+            self.__unlink(file['id'])
+            self.files[file['id']] = file
+            for parent in parents:
+                self.__children[parent].add(file['id'])
+            if file.get('mimeType') == G_DRIVE_DIR_MIME_TYPE:
+                self.__children.setdefault(file['id'], set())
+            for gram in trigrams(file.get('name', '')):
+                self.__grams.setdefault(gram, set()).add(file['id'])
+
+    # Removes an entry with everything below it
+    def remove(self, file_id):
+        with self.__lock:
+            self.__remove(file_id)
+
+    def __remove(self, file_id):
+        stack = [file_id]
+        while stack:
+            file_id = stack.pop()
+            self.__unlink(file_id)
+            self.files.pop(file_id, None)
+            stack.extend(self.__children.pop(file_id, ()))
+
+    def __unlink(self, file_id):
+        file = self.files.get(file_id)
+        if file is None:
+            return
+        for parent in file.get('parents') or ():
+            self.__children.get(parent, set()).discard(file_id)
+        for gram in trigrams(file.get('name', '')):
+            postings = self.__grams.get(gram)
+            if postings is not None:
+                postings.discard(file_id)
+                if not postings:
+                    del self.__grams[gram]
+
+    # Same results and paging as DriveTreeCache.search
+    def search(self, name, folder=None, limit=20, next_page_token=None):
+        name = name.lower()
+        with self.__lock:
+            grams = trigrams(name)
+            if grams:
+                postings = sorted((self.__grams.get(gram, ()) for gram in grams), key=len)
+                candidates = set(postings[0]).intersection(*postings[1:])
+            else:
+                candidates = self.files.keys()
+            if folder:
+                candidates = self.__children.get(folder, set()).intersection(candidates)
+            files = [self.files[file_id] for file_id in candidates if name in self.files[file_id].get('name', '').lower()]
+        files.sort(key=lambda file: file.get('modifiedTime', ''), reverse=True)
+        start = int(next_page_token or 0)
+        next_page_token = str(start + limit) if start + limit < len(files) else None
+        return files[start:start + limit], next_page_token
+
+# Live counters of the transfers and API calls of a client, cheap enough to
+# stay on. snapshot() returns them as a dict, which is also what the callback gets.
+class TransferMetrics:
+    def __init__(self, callback=None, interval=PROGRESS_INTERVAL):
+        self.callback = callback
+        self.interval = interval
+        self.__lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.__lock:
+            self.started = time.time()
+            self.bytes = self.total_bytes = 0
+            self.files = self.total_files = 0
+            self.throughput = self.average_throughput = 0.0
+            self.requests = {}
+            self.errors = {}
+            self.waits = {}
+            self.retries = {}
+            self.latency = {}
+            self.__sample = (time.monotonic(), 0)
+            self.__notified = 0
+
+    def add_total(self, size=0, files=0):
+        with self.__lock:
+            self.total_bytes += size
+            self.total_files += files
+
+    def set_bytes(self, size):
+        with self.__lock:
+            self.bytes = size
+            self.__sample = (time.monotonic(), size)
+
+    def add_progress(self, size, files=0):
+        with self.__lock:
+            self.bytes += size
+            self.files += files
+            now = time.monotonic()
+            sampled, done = self.__sample
+            if now - sampled >= THROUGHPUT_INTERVAL:
+                self.throughput = (self.bytes - done) / (now - sampled)
+                self.average_throughput = self.throughput if not self.average_throughput else \
+                    THROUGHPUT_SMOOTHING * self.throughput + (1 - THROUGHPUT_SMOOTHING) * self.average_throughput
+                self.__sample = (now, self.bytes)
+            notify = self.callback and (now - self.__notified >= self.interval or
+                                        self.files == self.total_files and files)
+            if notify:
+                self.__notified = now
+        if notify:
+            self.callback(self.snapshot())
+
+    def add_request(self, method, seconds, reason=None):
+        with self.__lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+            # Count of every bucket, followed by the total time
+            histogram = self.latency.get(method)
+            if histogram is None:
+                histogram = self.latency[method] = [0] * (len(LATENCY_BUCKETS) + 1)
+            histogram[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            histogram[-1] += seconds
+            if reason:
+                self.errors[reason] = self.errors.get(reason, 0) + 1
+
+    def add_error(self, reason):
+        with self.__lock:
+            self.errors[reason] = self.errors.get(reason, 0) + 1
+
+    # Time spent waiting on the rate limiter
+    def add_wait(self, kind, seconds):
+        with self.__lock:
+            count, total = self.waits.get(kind, (0, 0.0))
+            self.waits[kind] = (count + 1, total + seconds)
+
+    # Calls sent again after an error, and the backoff before them, by reason
+    def add_retry(self, reason, seconds):
+        with self.__lock:
+            count, total = self.retries.get(reason, (0, 0.0))
+            self.retries[reason] = (count + 1, total + seconds)
+
+    @property
+    def eta(self):
+        remaining = self.total_bytes - self.bytes
+        if remaining <= 0 or not self.average_throughput:
+            return None
+        return remaining / self.average_throughput
+
+    def snapshot(self):
+        with self.__lock:
+            return {
+                'bytes': self.bytes,
+                'total_bytes': self.total_bytes,
+                'files': self.files,
+                'total_files': self.total_files,
+                'elapsed': time.time() - self.started,
+                'throughput': self.throughput,
+                'average_throughput': self.average_throughput,
+                'eta': self.eta,
+                'requests': dict(self.requests),
+                'errors': dict(self.errors),
+                'waits': {kind: {'count': count, 'seconds': seconds} for kind, (count, seconds) in self.waits.items()},
+                'retries': {reason: {'count': count, 'seconds': seconds}
+                            for reason, (count, seconds) in self.retries.items()},
+                'latency': {method: latency_summary(histogram) for method, histogram in self.latency.items()},
+            }
+
+class SyncItem:
+    def __init__(self, path, source, folder, name, size, file_id=None, md5=None):
+        self.path = path
+        self.source = source
+        self.folder = folder
+        self.name = name
+        self.size = size
+        self.file_id = file_id
+        self.md5 = md5
+        self.copied = None
+
+    def __repr__(self):
+        return f"<SyncItem {self.path} size={self.size}{' replace' if self.file_id else ''}>"
+
+class SyncPlan:
+    def __init__(self, src, dest_folder, local):
+        self.src = src
+        self.dest_folder = dest_folder
+        self.local = local
+        self.folders = []
+        self.transfers = []
+        self.deletions = []
+        # Paths whose files couldn't be paired one to one, with the files of dest left
+        self.ambiguous = []
+        self.result = None
+        self.existing = None
+        self.index = None
+
+    @property
+    def bytes(self):
+        return sum(item.size for item in self.transfers)
+
+    # Upper bound of the API calls needed, adaptive chunks need fewer requests
+    @property
+    def requests(self):
+        count = len(self.folders) + -(-len(self.deletions) // BATCH_SIZE)
+        for item in self.transfers:
+            if not self.local:
+                count += 2 if item.file_id else 1
+            elif item.size <= MULTIPART_UPLOAD_SIZE:
+                count += 1
+            else:
+                count += 2 + -(-item.size // INITIAL_CHUNK_SIZE)
+        return count
+
+    def __repr__(self):
+        return (f"<SyncPlan folders={len(self.folders)} transfers={len(self.transfers)} "
+                f"deletions={len(self.deletions)} bytes={self.bytes} requests={self.requests}>")
+
+class ClonePlan(SyncPlan):
+    def __init__(self, src, dest_folder, name):
+        SyncPlan.__init__(self, src, dest_folder, False)
+        self.name = name
+        self.target = None
+        self.duplicates = []
+
+    def __repr__(self):
+        return (f"<ClonePlan {self.name} folders={len(self.folders)} transfers={len(self.transfers)} "
+                f"duplicates={len(self.duplicates)} ambiguous={len(self.ambiguous)} bytes={self.bytes} "
+                f"requests={self.requests}>")
+
+class SyncIndex:
+    def __init__(self, path=':memory:'):
+        self.path = path
+        self.hashes = HashCache(path)
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(path, check_same_thread=False)
+        self.__db.execute("CREATE TABLE IF NOT EXISTS remote (id TEXT PRIMARY KEY, name TEXT, parent TEXT, "
+                          "size INTEGER, md5 TEXT, mimeType TEXT, modifiedTime TEXT)")
+        self.__db.execute("CREATE INDEX IF NOT EXISTS remote_parent ON remote (parent, name)")
+        self.__db.execute("CREATE TABLE IF NOT EXISTS listed (id TEXT PRIMARY KEY, listed REAL)")
+        self.__db.commit()
+
+    # None when the folder was never listed
+    def children(self, parent):
+        with self.__lock:
+            if self.__db.execute("SELECT 1 FROM listed WHERE id=?", (parent,)).fetchone() is None:
+                return None
+            rows = self.__db.execute("SELECT id, name, size, md5, mimeType, modifiedTime FROM remote WHERE parent=?",
+                                     (parent,)).fetchall()
+        return [{'id': row[0], 'name': row[1], 'size': row[2], 'md5Checksum': row[3],
+                 'mimeType': row[4], 'modifiedTime': row[5]} for row in rows]
+
+    def replace_children(self, parent, files):
+        with self.__lock:
+            self.__db.execute("DELETE FROM remote WHERE parent=?", (parent,))
+            self.__db.executemany("INSERT OR REPLACE INTO remote VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                  [self.__row(file, parent) for file in files])
+            self.__db.execute("INSERT OR REPLACE INTO listed VALUES (?, ?)", (parent, time.time()))
+            self.__db.commit()
+
+    def put(self, file, parent):
+        with self.__lock:
+            self.__db.execute("INSERT OR REPLACE INTO remote VALUES (?, ?, ?, ?, ?, ?, ?)", self.__row(file, parent))
+            self.__db.commit()
+
+    def remove(self, file_id):
+        with self.__lock:
+            self.__db.execute("DELETE FROM remote WHERE id=?", (file_id,))
+            self.__db.commit()
+
+    def __row(self, file, parent):
+        size = file.get('size')
+        return (file.get('id'), file.get('name'), parent, int(size) if size is not None else None,
+                file.get('md5Checksum'), file.get('mimeType'), file.get('modifiedTime'))
+
+# MD5 of local files, computed again only when the file changed
+class HashCache:
+    def __init__(self, path=':memory:'):
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(path, check_same_thread=False)
+        self.__db.execute("CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, inode INTEGER, "
+                          "size INTEGER, mtime INTEGER, md5 TEXT)")
+        self.__db.commit()
+
+    def md5(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        with self.__lock:
+            row = self.__db.execute("SELECT inode, size, mtime, md5 FROM hashes WHERE path=?", (path,)).fetchone()
+        if row and tuple(row[:3]) == key:
+            return row[3]
+        md5 = file_md5(path)
+        with self.__lock:
+            self.__db.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)", (path,) + key + (md5,))
+            self.__db.commit()
+        return md5
+
+# Drive ids of uploaded contents by md5 and size, so the same content is copied on
+# Drive instead of being uploaded again. Local checksums are kept in a HashCache.
+class DedupCache:
+    def __init__(self, path=':memory:'):
+        self.hashes = HashCache(path)
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(path, check_same_thread=False)
+        self.__db.execute("CREATE TABLE IF NOT EXISTS contents (md5 TEXT, size INTEGER, id TEXT, "
+                          "PRIMARY KEY (md5, size))")
+        self.__db.commit()
+
+    def get(self, md5, size):
+        with self.__lock:
+            row = self.__db.execute("SELECT id FROM contents WHERE md5=? AND size=?", (md5, size)).fetchone()
+        return row[0] if row else None
+
+    def put(self, md5, size, file_id):
+        with self.__lock:
+            self.__db.execute("INSERT OR REPLACE INTO contents VALUES (?, ?, ?)", (md5, size, file_id))
+            self.__db.commit()
+
+    def remove(self, md5, size):
+        with self.__lock:
+            self.__db.execute("DELETE FROM contents WHERE md5=? AND size=?", (md5, size))
+            self.__db.commit()
+
+class UploadJournal:
+    def __init__(self, path):
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(path, check_same_thread=False)
+        self.__db.execute("CREATE TABLE IF NOT EXISTS uploads (path TEXT, parent TEXT, name TEXT, size INTEGER, "
+                          "mtime REAL, uri TEXT, offset INTEGER, updated REAL, PRIMARY KEY (path, parent, name))")
+        self.__db.commit()
+
+    def get(self, path, parent, name, size, mtime):
+        with self.__lock:
+            row = self.__db.execute("SELECT size, mtime, uri, offset FROM uploads WHERE path=? AND parent=? AND name=?",
+                                    (os.path.abspath(path), parent, name)).fetchone()
+        if row is None:
+            return None
+        # The file changed since the session was started, its bytes can't be reused
+        if row[0] != size or row[1] != mtime:
+            self.remove(path, parent, name)
+            return None
+        return row[2], row[3]
+
+    def save(self, path, parent, name, size, mtime, uri, offset):
+        with self.__lock:
+            self.__db.execute("INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                              (os.path.abspath(path), parent, name, size, mtime, uri, offset, time.time()))
+            self.__db.commit()
+
+    def remove(self, path, parent, name):
+        with self.__lock:
+            self.__db.execute("DELETE FROM uploads WHERE path=? AND parent=? AND name=?",
+                              (os.path.abspath(path), parent, name))
+            self.__db.commit()
+
+    def close(self):
+        self.__db.close()
+
+# Checkpoints of clone and upload jobs, the destination id of every finished
+# source item of a job. Commits are batched, folders are committed right away.
+class JobJournal:
+    def __init__(self, path):
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__pending = 0
+        self.__committed = time.time()
+        self.__db = sqlite3.connect(path, check_same_thread=False)
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        self.__db.execute("PRAGMA synchronous=NORMAL")
+        self.__db.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, kind TEXT, source TEXT, dest TEXT, "
+                          "started REAL, finished REAL)")
+        self.__db.execute("CREATE TABLE IF NOT EXISTS items (job TEXT, source TEXT, dest TEXT, "
+                          "PRIMARY KEY (job, source))")
+        self.__db.commit()
+
+    # Returns the finished items of the job, {source: destination id}
+    def start(self, job, kind, source, dest):
+        with self.__lock:
+            row = self.__db.execute("SELECT kind, source, dest FROM jobs WHERE id=?", (job,)).fetchone()
+            if row is None:
+                self.__db.execute("INSERT INTO jobs VALUES (?, ?, ?, ?, ?, NULL)", (job, kind, source, dest, time.time()))
+                self.__db.commit()
+                return {}
+            if row != (kind, source, dest):
+                raise GoogleDriveError(f"Job {job} is a {row[0]} of {row[1]} to {row[2]}, not of {source} to {dest}.")
+            return dict(self.__db.execute("SELECT source, dest FROM items WHERE job=?", (job,)))
+
+    def done(self, job, source, dest, flush=False):
+        with self.__lock:
+            self.__db.execute("INSERT OR REPLACE INTO items VALUES (?, ?, ?)", (job, source, dest))
+            self.__pending += 1
+            if flush or self.__pending >= CHECKPOINT_BATCH or time.time() - self.__committed >= CHECKPOINT_INTERVAL:
+                self.__commit()
+
+    def finish(self, job, completed=True):
+        with self.__lock:
+            self.__db.execute("UPDATE jobs SET finished=? WHERE id=?", (time.time() if completed else None, job))
+            self.__commit()
+
+    def finished(self, job):
+        with self.__lock:
+            row = self.__db.execute("SELECT finished FROM jobs WHERE id=?", (job,)).fetchone()
+        return bool(row and row[0])
+
+    def flush(self):
+        with self.__lock:
+            self.__commit()
+
+    def __commit(self):
+        self.__db.commit()
+        self.__pending = 0
+        self.__committed = time.time()
+
+    def remove(self, job):
+        with self.__lock:
+            self.__db.execute("DELETE FROM items WHERE job=?", (job,))
+            self.__db.execute("DELETE FROM jobs WHERE id=?", (job,))
+            self.__commit()
+
+    def close(self):
+        self.flush()
+        self.__db.close()
+
+class ServiceAccount:
+    def __init__(self, index, credentials):
+        self.index = index
+        self.credentials = credentials
+        self.exhausted_until = 0
+        self.bytes = 0
+        self.day = None
+        self.__local = threading.local()
+        self.__shared = {}
+        self.__lock = threading.Lock()
+
+    # One ready client per account and thread, or per account and pooled transport
+    def service(self, transport=None):
+        if transport is not None:
+            with self.__lock:
+                if transport not in self.__shared:
+                    self.__shared[transport] = build_service(self.credentials, transport)
+                return self.__shared[transport]
+        service = getattr(self.__local, 'service', None)
+        if service is None:
+            service = self.__local.service = build_service(self.credentials)
+        return service
+
+    def available(self, now):
+        return self.exhausted_until <= now
+
+    def __repr__(self):
+        return f"<ServiceAccount {self.index}.json bytes={self.bytes}>"
+
+class ServiceAccountPool:
+    __pools = {}
+    __pools_lock = threading.Lock()
+
+    def __init__(self, path):
+        _load()
+        parse_service_accounts(path)
+        names = sorted((name for name in os.listdir(path) if name.lower().endswith('.json')),
+                       key=lambda name: (len(name), name))
+        self.accounts = [ServiceAccount(i, service_account.Credentials.from_service_account_file(
+            os.path.join(path, name), scopes=OAUTH_SCOPE)) for i, name in enumerate(names)]
+        self.__next = 0
+        self.__lock = threading.Lock()
+
+    # Credentials are read from disk once per directory and process
+    @classmethod
+    def load(cls, path):
+        path = os.path.abspath(path)
+        with cls.__pools_lock:
+            if path not in cls.__pools:
+                cls.__pools[path] = cls(path)
+            return cls.__pools[path]
+
+    def acquire(self):
+        now = time.time()
+        with self.__lock:
+            for _ in range(len(self.accounts)):
+                account = self.accounts[self.__next]
+                self.__next = (self.__next + 1) % len(self.accounts)
+                if account.available(now):
+                    return account
+        raise GoogleDriveError("All service accounts have exceeded their quota.")
+
+    def exhausted(self, account, reason='dailyLimitExceeded'):
+        with self.__lock:
+            account.exhausted_until = time.time() + SERVICE_ACCOUNT_COOLDOWN.get(reason, QUOTA_COOLDOWN)
+        LOGGER.info(f"{account.index}.json service account got {reason}")
+
+    def add_usage(self, account, size):
+        today = time.strftime('%Y-%m-%d', time.gmtime())
+        with self.__lock:
+            if account.day != today:
+                account.day, account.bytes = today, 0
+            account.bytes += size
+            # Stops giving out the account before Drive starts rejecting it
+            if account.bytes >= DAILY_UPLOAD_LIMIT:
+                account.exhausted_until = time.time() + QUOTA_COOLDOWN
+
+class _TokenBucket:
+    def __init__(self, rate):
+        self.max_rate = self.rate = float(rate)
+        self.tokens = self.rate
+        self.updated = self.increased = time.monotonic()
+        self.decreased = 0
+        self.__lock = threading.Lock()
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+    # Takes a token and returns how long the caller has to wait before using it
+    def reserve(self):
+        with self.__lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # The token is reserved right away, callers sleep off the debt in order
+            self.tokens -= 1
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    # Successful requests bring the rate back by 1% of max_rate per second, however
+    # many there are, a halved rate is back to full after 50 seconds without errors
+    def increase(self):
+        with self.__lock:
+            now = time.monotonic()
+            self.rate = min(self.max_rate, self.rate + (now - self.increased) * self.max_rate / 100)
+            self.increased = now
+
+    def decrease(self):
+        with self.__lock:
+            now = time.monotonic()
+            # Errors of requests which were already in flight count once
+            if now - self.decreased < 1:
+                return False
+            self.decreased = self.increased = now
+            self.rate = max(1.0, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+            return True
+
+class RateLimiter:
+    __shared = {}
+    __lock = threading.Lock()
+
+    def __init__(self, queries=QUERY_RATE, writes=WRITE_RATE):
+        self.buckets = {QUERY: _TokenBucket(queries), WRITE: _TokenBucket(writes)}
+
+    # One limiter per user, shared by every GoogleDrive instance and thread in the process
+    @classmethod
+    def shared(cls, credentials):
+        key = credentials_key(credentials)
+        with cls.__lock:
+            if key not in cls.__shared:
+                cls.__shared[key] = cls()
+            return cls.__shared[key]
+
+    def acquire(self, kind=WRITE):
+        self.buckets[kind].acquire()
+
+    def reserve(self, kind=WRITE):
+        return self.buckets[kind].reserve()
+
+    def succeeded(self, kind=WRITE):
+        self.buckets[kind].increase()
+
+    def throttled(self, kind=WRITE):
+        if self.buckets[kind].decrease():
+            LOGGER.debug(f"Rate limited, {kind} rate lowered to {self.buckets[kind].rate:.1f}/s")
+
+class ChunkSizer:
+    def __init__(self, initial=INITIAL_CHUNK_SIZE, maximum=MAX_CHUNK_SIZE, target=CHUNK_TARGET_SECONDS):
+        self.chunksize = initial
+        self.maximum = maximum
+        self.target = target
+        self.throughput = None
+        self.errors = 0.0
+
+    def update(self, size, seconds):
+        if size <= 0:
+            return
+        throughput = size / max(seconds, 0.001)
+        if self.throughput is None:
+            self.throughput = throughput
+        else:
+            self.throughput = 0.7 * self.throughput + 0.3 * throughput
+        self.errors *= 0.5
+        # Doubles at most per chunk and stops growing while chunks keep failing
+        limit = self.chunksize * 2 if self.errors < 0.1 else self.chunksize
+        self.__resize(max(min(self.throughput * self.target, limit), self.chunksize // 2))
+
+    def failed(self):
+        self.errors += 1
+        self.__resize(self.chunksize // 2)
+
+    def __resize(self, size):
+        size = int(size) // CHUNK_SIZE_STEP * CHUNK_SIZE_STEP
+        self.chunksize = max(CHUNK_SIZE_STEP, min(self.maximum, size))
+
+# Resumable upload of a stream with unknown size, like a pipe or a generator of
+# bytes. Data is kept from the last committed offset so failed chunks can be sent again.
+def _stream_upload_class(MediaIoBaseUpload):
+    class _StreamUpload(MediaIoBaseUpload):
+        def __init__(self, stream, mimetype, chunksize):
+            self._fd = stream
+            self._iter = None if hasattr(stream, 'read') else iter(stream)
+            self._mimetype = mimetype
+            self._chunksize = chunksize
+            self._resumable = True
+            self._size = None
+            self._buffer = bytearray()
+            self._offset = 0
+            self._eof = False
+
+        def __read(self, length):
+            if self._iter is None:
+                return self._fd.read(length)
+            try:
+                return next(self._iter)
+            except StopIteration:
+                return b''
+
+        def prefetch(self, end):
+            # One byte more than asked, so the size is known before the last chunk is sent
+            while not self._eof and self._offset + len(self._buffer) <= end:
+                data = self.__read(end + 1 - self._offset - len(self._buffer))
+                if not data:
+                    self._eof = True
+                    self._size = self._offset + len(self._buffer)
+                self._buffer += data
+
+        def getbytes(self, begin, length):
+            # Everything before begin is committed by the server
+            del self._buffer[:begin - self._offset]
+            self._offset = begin
+            self.prefetch(begin + length)
+            return bytes(self._buffer[:length])
+
+        def has_stream(self):
+            return False
+
+        def size(self):
+            return self._size
+
+        def to_json(self):
+            raise NotImplementedError('Stream uploads can not be serialized.')
+    return _StreamUpload
+
+# A file downloaded in chunks into a preallocated .part file. The finished chunks
+# are listed in a .part.json next to it, the file is renamed once all are written.
+class _Download:
+    def __init__(self, meta, path, chunk_size):
+        self.meta = meta
+        self.path = path
+        self.size = int(meta.get('size') or 0)
+        self.part = path + '.part'
+        self.state = path + '.part.json'
+        self.ranges = [(start, min(start + chunk_size, self.size) - 1) for start in range(0, self.size, chunk_size)]
+        self.key = [meta.get('id'), meta.get('md5Checksum') or meta.get('modifiedTime'), self.size, chunk_size]
+        self.done = set()
+        self.failed = False
+        self.__lock = threading.Lock()
+
+    # An earlier download of the same content
+    def completed(self):
+        return (os.path.isfile(self.path) and os.path.getsize(self.path) == self.size and
+                bool(self.meta.get('md5Checksum')) and file_md5(self.path) == self.meta.get('md5Checksum'))
+
+    # Returns the indexes of the chunks still missing
+    def start(self):
+        if os.path.isfile(self.part) and os.path.getsize(self.part) == self.size:
+            try:
+                with open(self.state) as f:
+                    state = json.load(f)
+                if state.get('key') == self.key:
+                    self.done = set(state.get('done'))
+            except (OSError, ValueError):
+                pass
+        if not self.done:
+            with open(self.part, 'wb') as f:
+                if self.size and hasattr(os, 'posix_fallocate'):
+                    os.posix_fallocate(f.fileno(), 0, self.size)
+                f.truncate(self.size)
+        return [index for index in range(len(self.ranges)) if index not in self.done]
+
+    def missing_bytes(self, missing):
+        return sum(self.ranges[index][1] - self.ranges[index][0] + 1 for index in missing)
+
+    # Returns True once every chunk is written
+    def write(self, index, data):
+        offset = self.ranges[index][0]
+        fd = os.open(self.part, os.O_WRONLY)
+        try:
+            view = memoryview(data)
+            while view:
+                written = pwrite(fd, view, offset)
+                view, offset = view[written:], offset + written
+        finally:
+            os.close(fd)
+        with self.__lock:
+            self.done.add(index)
+            # Single chunk files are simply downloaded again
+            if len(self.ranges) > 1 and len(self.done) < len(self.ranges):
+                with open(self.state + '.tmp', 'w') as f:
+                    json.dump({'key': self.key, 'done': sorted(self.done)}, f)
+                os.replace(self.state + '.tmp', self.state)
+            return len(self.done) == len(self.ranges)
+
+    def finish(self):
+        md5 = self.meta.get('md5Checksum')
+        if md5 and file_md5(self.part) != md5:
+            self.discard()
+            raise GoogleDriveError(f"Checksum of {self.path} doesn't match, it's downloaded again next time.")
+        os.replace(self.part, self.path)
+        if os.path.exists(self.state):
+            os.remove(self.state)
+
+    def discard(self):
+        for path in (self.part, self.state):
+            if os.path.exists(path):
+                os.remove(path)
+
+    # Returns True for the first failure of the file
+    def fail(self):
+        with self.__lock:
+            failed, self.failed = self.failed, True
+        return not failed
+
+# Reads a Drive file in chunks fetched by fetch(start, end), keeping read_ahead
+# chunks after the current one in flight. Seeking outside of them drops them.
+class DriveReader(io.RawIOBase):
+    def __init__(self, fetch, meta, chunk_size=STREAM_CHUNK_SIZE, read_ahead=2):
+        super().__init__()
+        self.name = meta.get('name')
+        self.size = int(meta.get('size') or 0)
+        self.chunk_size = chunk_size
+        self.read_ahead = read_ahead
+        self.__fetch = fetch
+        self.__position = 0
+        self.__chunks = {}
+        self.__executor = ThreadPoolExecutor(max_workers=read_ahead + 1)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.__position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.__position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self.__position = offset
+        return offset
+
+    def readinto(self, buffer):
+        if self.__position >= self.size:
+            return 0
+        index, offset = divmod(self.__position, self.chunk_size)
+        chunk = self.__chunk(index)
+        length = min(len(buffer), len(chunk) - offset)
+        buffer[:length] = chunk[offset:offset + length]
+        self.__position += length
+        return length
+
+    def __chunk(self, index):
+        last = (self.size - 1) // self.chunk_size
+        for stale in [i for i in self.__chunks if not index <= i <= index + self.read_ahead]:
+            self.__chunks.pop(stale).cancel()
+        for i in range(index, min(index + self.read_ahead, last) + 1):
+            if i not in self.__chunks:
+                start = i * self.chunk_size
+                end = min(start + self.chunk_size, self.size) - 1
+                self.__chunks[i] = self.__executor.submit(self.__fetch, start, end)
+        return self.__chunks[index].result()
+
+    def close(self):
+        if not self.closed:
+            for future in self.__chunks.values():
+                future.cancel()
+            self.__chunks = {}
+            self.__executor.shutdown(wait=False)
+        super().close()
+
+# Thread-safe pool of keep-alive connections shared by every thread and service using
+# it. Services talk to it through an httplib2 compatible facade, googleapiclient is
+# unchanged. TCP keepalive probes keep idle connections from being dropped silently.
+class PooledTransport:
+    errors = ()
+    connect_errors = ()
+
+    def __init__(self, connections=10, timeout=120, keepalive=30):
+        try:
+            import urllib3
+        except ImportError:
+            raise GoogleDriveError("PooledTransport needs urllib3, install it with pip install urllib3.") from None
+        self.connections = connections
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self.errors = (urllib3.exceptions.HTTPError,)
+        self.connect_errors = (urllib3.exceptions.ConnectTimeoutError,)
+        options = urllib3.connection.HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            options += [(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, keepalive),
+                        (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, keepalive)]
+        self.__pool = urllib3.PoolManager(num_pools=4, maxsize=connections, block=True, retries=False,
+                                          timeout=urllib3.Timeout(connect=30, read=timeout), socket_options=options)
+
+    # An authorized http for a service, refreshing the credentials when needed
+    def authorize(self, credentials):
+        if isinstance(credentials, OAuth2Credentials):
+            return credentials.authorize(_TransportHttp(self))
+        return google_auth_httplib2.AuthorizedHttp(credentials, http=_TransportHttp(self))
+
+    # Same signature and result as httplib2.Http.request
+    def request(self, uri, method='GET', body=None, headers=None, redirections=5, connection_type=None):
+        follow = redirections > 0 and method in ('GET', 'HEAD')
+        # Chunks of resumable uploads are slices of the file, sent as they are read with the
+        # Content-Length set by googleapiclient, a chunk is never held in memory as a whole
+        if hasattr(body, 'read'):
+            stream = body
+            body = iter(lambda: stream.read(SEND_BLOCK_SIZE), b'')
+        try:
+            status, reason, headers, content = self._send(uri, method, body, dict(headers or {}), follow)
+        except self.connect_errors as err:
+            raise _ConnectError(f"{method} {uri} failed: {err}") from err
+        except self.errors as err:
+            raise ConnectionError(f"{method} {uri} failed: {err}") from err
+        response = httplib2.Response(dict(headers.items(), status=str(status)))
+        response.reason = reason
+        return response, content
+
+    def _send(self, uri, method, body, headers, follow):
+        response = self.__pool.request(method, uri, body=body, headers=headers, redirect=follow)
+        return response.status, response.reason, response.headers, response.data
+
+    def close(self):
+        self.__pool.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Multiplexes the requests over a few HTTP/2 connections with httpx, needs
+# pip install gdnan[http2]. Servers without HTTP/2 are spoken to with HTTP/1.1.
+class Http2Transport(PooledTransport):
+    def __init__(self, connections=4, timeout=120, keepalive=30):
+        try:
+            import httpx
+        except ImportError:
+            raise GoogleDriveError("Http2Transport needs httpx, install it with pip install gdnan[http2].") from None
+        self.connections = connections
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self.errors = (httpx.TransportError,)
+        self.connect_errors = (httpx.ConnectError, httpx.ConnectTimeout)
+        self.__client = httpx.Client(http2=True, timeout=httpx.Timeout(timeout, connect=30),
+                                     limits=httpx.Limits(max_connections=connections,
+                                                         max_keepalive_connections=connections,
+                                                         keepalive_expiry=keepalive))
+
+    def _send(self, uri, method, body, headers, follow):
+        response = self.__client.request(method, uri, content=body, headers=headers, follow_redirects=follow)
+        return response.status_code, response.reason_phrase, response.headers, response.content
+
+    def close(self):
+        self.__client.close()
+
+# oauth2client authorizes an http by replacing its request method, so every
+# service gets its own facade of the shared transport
+class _TransportHttp:
+    def __init__(self, transport):
+        self.transport = transport
+        self.redirect_codes = frozenset((301, 302, 303, 307))
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=5, connection_type=None):
+        return self.transport.request(uri, method, body, headers, redirections, connection_type)
+
+    def close(self):
+        pass
+
+class _ByteBudget:
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.__condition = threading.Condition()
+
+    def acquire(self, size):
+        # A single item larger than the limit is allowed once nothing else is in flight
+        size = min(size, self.limit)
+        with self.__condition:
+            while self.used and self.used + size > self.limit:
+                self.__condition.wait()
+            self.used += size
+        return size
+
+    def release(self, size):
+        with self.__condition:
+            self.used -= size
+            self.__condition.notify_all()
 
 class Auth:
     def __init__(self, GooogleDriveClientID, GooogleDriveClientSecret):
+        _load()
         self.__flow = OAuth2WebServerFlow(
               GooogleDriveClientID,
               GooogleDriveClientSecret,
@@ -489,10 +3116,294 @@ class Auth:
 
 
 class GoogleDriveError(Exception):
-    def __init__(self, m):
+    def __init__(self, m, reason=None, status=None, retry_after=None):
         self.message = m
+        self.reason = reason
+        self.status = status
+        self.retry_after = retry_after
     def __str__(self):
-        return self.message.replace("<","").replace(">","")
+        return str(self.message).replace("<","").replace(">","")
+
+# Failed API calls are raised as one of these, by the reason Drive gave
+class RateLimitError(GoogleDriveError):
+    pass
+
+class QuotaExceededError(GoogleDriveError):
+    pass
+
+class ServerError(GoogleDriveError):
+    pass
+
+class NetworkError(GoogleDriveError):
+    # False when the connection failed before the request was sent
+    sent = True
+
+class NotFoundError(GoogleDriveError):
+    pass
+
+class PermissionDeniedError(GoogleDriveError):
+    pass
+
+# Retries an error up to `retries` times, waiting a random time up to base * 2 ** attempt
+# seconds, at most cap ("full jitter"), or longer if the server sent a Retry-After.
+class RetryPolicy:
+    def __init__(self, retries=5, base=1, cap=32):
+        self.retries = retries
+        self.base = base
+        self.cap = cap
+
+    def delay(self, attempt, retry_after=None):
+        return max(random.uniform(0, min(self.cap, self.base * 2 ** attempt)), retry_after or 0)
+
+    def __repr__(self):
+        return f"<RetryPolicy retries={self.retries} base={self.base} cap={self.cap}>"
+
+# Policies by reason and then by error class, errors without one aren't retried
+RETRY_POLICIES = {
+    'rateLimitExceeded': RetryPolicy(retries=8, base=1, cap=64),
+    'userRateLimitExceeded': RetryPolicy(retries=8, base=2, cap=64),
+    RateLimitError: RetryPolicy(retries=8, base=1, cap=64),
+    ServerError: RetryPolicy(retries=6, base=0.5, cap=32),
+    NetworkError: RetryPolicy(retries=5, base=0.5, cap=16),
+}
+
+# A call which isn't idempotent, like files.create or files.copy, may have been done by
+# Drive when the connection broke after sending it, so it's only retried if it wasn't sent
+def retry_policy(err, idempotent=True):
+    if not idempotent and isinstance(err, NetworkError) and err.sent:
+        return None
+    return RETRY_POLICIES.get(err.reason) or RETRY_POLICIES.get(type(err))
+
+# The GoogleDriveError of a failed response, from its status, JSON body and headers
+def classify_error(status, content=b'', headers=None):
+    reason, message = error_details(content or b'')
+    if reason in RATE_LIMIT_REASONS or status == 429:
+        cls = RateLimitError
+    elif reason in QUOTA_REASONS:
+        cls = QuotaExceededError
+    elif reason in SERVER_ERROR_REASONS or status >= 500:
+        cls = ServerError
+    elif status in (404, 410):
+        cls = NotFoundError
+    elif status in (401, 403):
+        cls = PermissionDeniedError
+    else:
+        cls = GoogleDriveError
+    retry_after = (headers or {}).get('retry-after')
+    return cls(message or f"HTTP {status}", reason or str(status), status, parse_retry_after(retry_after))
+
+def network_error(err):
+    error = NetworkError(str(err) or type(err).__name__, type(err).__name__)
+    error.sent = not isinstance(err, UNSENT_ERRORS)
+    return error
+
+# Seconds to wait from a Retry-After header, given in seconds or as an HTTP date
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def error_details(err):
+    content = err if isinstance(err, bytes) else err.content
+    try:
+        error = json.loads(content).get('error')
+        return error.get('errors')[0].get('reason'), error.get('errors')[0].get('message')
+    except (ValueError, TypeError, AttributeError, IndexError):
+        return None, content.decode('utf-8', 'replace') if isinstance(err, bytes) else str(err)
+
+_discovery = None
+_discovery_lock = threading.Lock()
+
+def discovery_document():
+    global _discovery
+    with _discovery_lock:
+        if _discovery is None:
+            _discovery = json.loads(_load_discovery())
+    return _discovery
+
+# Clients created afterwards are built from document instead of Google's, to
+# point them at another root URL like a proxy or an emulator
+def set_discovery_document(document):
+    global _discovery
+    if isinstance(document, (str, bytes)):
+        document = json.loads(document)
+    with _discovery_lock:
+        _discovery = document
+
+def _load_discovery():
+    content = None
+    if os.path.isfile(DISCOVERY_CACHE):
+        with open(DISCOVERY_CACHE) as f:
+            content = f.read()
+        if time.time() - os.path.getmtime(DISCOVERY_CACHE) < DISCOVERY_TTL:
+            return content
+    try:
+        resp, fetched = build_http().request(DISCOVERY_URI)
+        if resp.status != 200:
+            raise GoogleDriveError(f"Couldn't fetch the discovery document, got HTTP {resp.status}.")
+        fetched = fetched.decode('utf-8')
+        json.loads(fetched)
+    except Exception as err:
+        # A stale document is still better than no client at all
+        if content is None:
+            raise
+        LOGGER.warning(f"Using stale discovery document: {err}")
+        return content
+    try:
+        os.makedirs(os.path.dirname(DISCOVERY_CACHE), exist_ok=True)
+        with open(DISCOVERY_CACHE + '.tmp', 'w') as f:
+            f.write(fetched)
+        os.replace(DISCOVERY_CACHE + '.tmp', DISCOVERY_CACHE)
+    except OSError as err:
+        LOGGER.warning(f"Couldn't cache the discovery document: {err}")
+    return fetched
+
+def build_service(credentials, transport=None):
+    _load()
+    if transport is None:
+        service = build_from_document(discovery_document(), credentials=credentials)
+    else:
+        service = build_from_document(discovery_document(), http=transport.authorize(credentials))
+    # Nested resources like files() are rebuilt with all of their methods on
+    # every call, they only depend on the http of the service so keep them.
+    for name in discovery_document().get('resources', {}):
+        service._set_dynamic_attr(name, _cached_resource(getattr(service, name)))
+    return service
+
+def _cached_resource(method):
+    resource = []
+    def cached():
+        if not resource:
+            resource.append(method())
+        return resource[0]
+    return cached
+
+# Count, mean and percentiles of a latency histogram of TransferMetrics, a
+# percentile is the upper bound of the bucket it falls in.
+def latency_summary(histogram):
+    counts, count = histogram[:-1], sum(histogram[:-1])
+    summary = {'count': count, 'mean': histogram[-1] / count if count else 0.0,
+               'buckets': dict(zip((str(bound) for bound in LATENCY_BUCKETS), counts))}
+    for name, q in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+        seen = 0
+        for bound, bucket in zip(LATENCY_BUCKETS, counts):
+            seen += bucket
+            if seen >= q * count:
+                summary[name] = bound
+                break
+    return summary
+
+def access_token_expired(credentials):
+    if isinstance(credentials, OAuth2Credentials):
+        return credentials.access_token_expired
+    return not credentials.valid
+
+def refresh_access_token(credentials, force=False):
+    if force or access_token_expired(credentials):
+        if isinstance(credentials, OAuth2Credentials):
+            credentials.refresh(build_http())
+        else:
+            credentials.refresh(google_auth_httplib2.Request(build_http()))
+    return credentials.access_token if isinstance(credentials, OAuth2Credentials) else credentials.token
+
+def credentials_key(credentials):
+    for attribute in ('service_account_email', 'refresh_token', 'client_id'):
+        if getattr(credentials, attribute, None):
+            return getattr(credentials, attribute)
+    return id(credentials)
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+class _Chunks:
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+# Yields a tar archive of (path, name, size) entries while it's written, one file at a
+# time. An empty chunk would end the upload, so only written data is yielded.
+def tar_stream(entries):
+    out = _Chunks()
+    tar = tarfile.open(fileobj=out, mode='w|', format=tarfile.PAX_FORMAT)
+    for path, name, _ in entries:
+        tar.add(path, name, recursive=False)
+        if out.chunks:
+            yield out.take()
+    tar.close()
+    yield out.take()
+
+# Extracts a tar stream into root and yields the size of every file, entries
+# other than files and folders or outside of root are refused
+def extract_tar(stream, root):
+    root = os.path.join(os.path.abspath(root), '')
+    with tarfile.open(fileobj=stream, mode='r|') as tar:
+        for member in tar:
+            target = os.path.abspath(os.path.join(root, member.name))
+            if not target.startswith(root) or not (member.isfile() or member.isdir()):
+                raise GoogleDriveError(f"Refusing to extract {member.name}.")
+            if member.isdir():
+                os.makedirs(target, exist_ok=True)
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with tar.extractfile(member) as source, open(target, 'wb') as f:
+                shutil.copyfileobj(source, f)
+            os.utime(target, (member.mtime, member.mtime))
+            yield member.size
+
+def trigrams(name):
+    name = name.lower()
+    return {name[i:i + 3] for i in range(len(name) - 2)}
+
+def pwrite(fd, data, offset):
+    if hasattr(os, 'pwrite'):
+        return os.pwrite(fd, data, offset)
+    # Every writer opens its own descriptor, so seeking is safe
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.write(fd, data)
+
+# Drive allows names which aren't valid file names
+def local_name(name):
+    return re.sub(r'[/\\\x00]', '_', name) or '_'
+
+# Name of the index-th of several files named name, "name (1).ext" and on for all
+# but the first, skipping the names of the other files of the folder in taken
+def sibling_name(name, index, taken):
+    if not index:
+        return name
+    stem, ext = os.path.splitext(name)
+    count = 0
+    for _ in range(index):
+        count += 1
+        while f"{stem} ({count}){ext}" in taken:
+            count += 1
+    return f"{stem} ({count}){ext}"
+
+def join_path(parent, name):
+    return f"{parent}/{name}" if parent else name
+
+def split_path(path):
+    parent, _, name = path.rpartition('/')
+    return parent, name
 
 def create_link(id, mimeType):
     if mimeType == G_DRIVE_DIR_MIME_TYPE: